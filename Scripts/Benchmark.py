@@ -0,0 +1,275 @@
+import argparse
+import time
+import tkinter as tk
+
+import numpy as np
+
+from Box import Box
+from ExpressionTypes import *
+import FormulaRepresentation as fr
+import ImageRecognition as ir
+import Rounds
+from SpatialIndex import GridIndex
+
+
+def ocr_benchmark(rounds_directory, model_path=ir.default_model_path, batch_size=32):
+    """ Replays the characters of the DatabaseCreator rounds through the recognition pipeline and prints latency
+    percentiles, throughput and accuracy against the displayed formulas """
+    rounds = Rounds.load_rounds(rounds_directory)
+    ir.init(model_path=model_path)
+    ir.warm_up()
+
+    # Gather characters, math symbols have no image and keep their recorded prediction
+    chars = [(round_index, char, target) for round_index, formula_round in enumerate(rounds)
+             for char, target in Rounds.round_characters(formula_round)]
+    cnn_chars = [i for i, (_, char, _) in enumerate(chars) if char["image"] is not None]
+    images = [np.asarray(chars[i][1]["image"], dtype=np.float32) for i in cnn_chars]
+    if len(images) == 0:
+        raise ValueError("No character image in " + rounds_directory)
+
+    print("{} rounds, {} characters, {} recognized by the CNN".format(len(rounds), len(chars), len(images)))
+
+    # Per character latency
+    preprocess_latencies, inference_latencies = [], []
+    for img in images:
+        start = time.perf_counter()
+        margin_imgs = ir.preprocessor.process([img])
+        middle = time.perf_counter()
+        ir.batch_predict(margin_imgs)
+        end = time.perf_counter()
+        preprocess_latencies.append(middle - start)
+        inference_latencies.append(end - middle)
+
+    total_latencies = np.add(preprocess_latencies, inference_latencies)
+    for stage, latencies in [("preprocess", preprocess_latencies), ("inference", inference_latencies),
+                             ("total", total_latencies)]:
+        p50, p90, p99 = 1e3 * np.percentile(latencies, [50, 90, 99])
+        print("{:>10} latency per character: p50 {:.3f} ms, p90 {:.3f} ms, p99 {:.3f} ms".format(stage, p50, p90, p99))
+
+    # Batched throughput
+    predictions = []
+    start = time.perf_counter()
+    for batch_start in range(0, len(images), batch_size):
+        predictions += ir.images_predict(images[batch_start:batch_start + batch_size])
+    elapsed = time.perf_counter() - start
+    print("Throughput with batches of {}: {:.0f} characters/s".format(batch_size, len(images) / elapsed))
+
+    # Accuracy against the displayed formulas
+    predicted = [char["prediction"] for _, char, _ in chars]
+    for i, prediction in zip(cnn_chars, predictions):
+        predicted[i] = prediction
+
+    known = [i for i, (_, _, target) in enumerate(chars) if target is not None]
+    known_cnn = [i for i in cnn_chars if chars[i][2] is not None]
+    if len(known) == 0:
+        print("No round can be aligned with its displayed formula, accuracy is unknown")
+        return
+
+    char_accuracy = np.mean([predicted[i] == chars[i][2] for i in known])
+    cnn_accuracy = np.mean([predicted[i] == chars[i][2] for i in known_cnn]) if len(known_cnn) > 0 else float("nan")
+    recorded_accuracy = np.mean([chars[i][1]["prediction"] == chars[i][2] for i in known])
+
+    # A formula is correct when all its characters are
+    formula_results = {}
+    for i in known:
+        formula_results[chars[i][0]] = formula_results.get(chars[i][0], True) and predicted[i] == chars[i][2]
+
+    print("Character accuracy: {:.1%} ({:.1%} on CNN characters, {:.1%} when recorded), on {} characters".format(
+        char_accuracy, cnn_accuracy, recorded_accuracy, len(known)))
+    print("Formula accuracy: {:.1%} on {} aligned rounds".format(np.mean(list(formula_results.values())),
+                                                                 len(formula_results)))
+
+
+def random_walks(strokes, points):
+    """ Returns (strokes, points, 2) random walk strokes spread over a page """
+    random = np.random.default_rng(0)
+    starts = random.uniform(50, 1400, (strokes, 1, 2))
+    steps = random.normal(0, 3, (strokes, points, 2))
+    return starts + np.cumsum(steps, axis=1)
+
+
+def canvas_benchmark(strokes=2000, points=60, runs=20):
+    """ Draws synthetic strokes with one canvas item per segment and with one polyline per stroke, then prints the
+    canvas item count and the redraw time of both pages. Without display, the strokes are rasterized offscreen """
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print("No display (" + str(e) + "), rasterizing offscreen instead")
+        raster_benchmark(strokes, points, runs)
+        return
+
+    walks = random_walks(strokes, points)
+
+    for mode in ["segments", "polylines"]:
+        canvas = tk.Canvas(root, bg="black", width=1440, height=1527)
+        canvas.pack()
+
+        start = time.perf_counter()
+        for walk in walks:
+            if mode == "segments":
+                for i in range(1, points):
+                    canvas.create_line(*walk[i - 1], *walk[i], width=7, fill="white", capstyle=tk.ROUND)
+            else:
+                canvas.create_line(*walk.ravel(), width=7, fill="white", capstyle=tk.ROUND, joinstyle=tk.ROUND)
+        root.update()
+        draw_time = time.perf_counter() - start
+
+        # Redraw the whole page: scroll it back and forth and ask for its bounds, as the scroll region does
+        redraw_times = []
+        for run_index in range(runs):
+            start = time.perf_counter()
+            canvas.move("all", 1 if run_index % 2 == 0 else -1, 0)
+            canvas.bbox("all")
+            root.update()
+            redraw_times.append(time.perf_counter() - start)
+
+        print("{:>9}: {} canvas items, drawn in {:.2f} s, redraw p50 {:.1f} ms, p90 {:.1f} ms".format(
+            mode, len(canvas.find_all()), draw_time, *(1e3 * np.percentile(redraw_times, [50, 90]))))
+
+        canvas.destroy()
+
+    root.destroy()
+
+
+def raster_benchmark(strokes=2000, points=60, runs=20):
+    """ Rasterizes the canvas benchmark strokes in a page sized image with PIL, once per segment item and once per
+    polyline item, and prints the item count and the redraw time of both pages """
+    from PIL import Image, ImageDraw
+
+    walks = random_walks(strokes, points)
+    radius = 3.5
+
+    for mode in ["segments", "polylines"]:
+        if mode == "segments":
+            items = [[tuple(walk[i - 1]), tuple(walk[i])] for walk in walks for i in range(1, points)]
+        else:
+            items = [[tuple(point) for point in walk] for walk in walks]
+
+        # Redraw the whole page, each item with its round caps as the canvas draws them
+        redraw_times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            page = Image.new("L", (1440, 1527))
+            draw = ImageDraw.Draw(page)
+            for item in items:
+                draw.line(item, fill=255, width=7, joint="curve")
+                for x, y in [item[0], item[-1]]:
+                    draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=255)
+            redraw_times.append(time.perf_counter() - start)
+
+        print("{:>9}: {} items, offscreen redraw p50 {:.1f} ms, p90 {:.1f} ms".format(
+            mode, len(items), *(1e3 * np.percentile(redraw_times, [50, 90]))))
+
+
+class BenchmarkCharacter(Box):
+    __slots__ = ("prediction",)
+
+    def __init__(self, prediction, x1, y1, x2, y2):
+        """ Recognized character without strokes """
+        super().__init__(x1, y1, x2, y2)
+        self.prediction = prediction
+
+    def get_type(self):
+        if is_digit(self.prediction):
+            return DIGIT
+        elif is_letter(self.prediction):
+            return LETTER
+        elif is_math_symbol(self.prediction):
+            return MATH
+        return PARENTHESIS
+
+    def __str__(self):
+        return self.prediction
+
+
+def synthetic_formula(random, length, x=0.0, y=0.0, size=40.0, depth=0):
+    """ Returns the characters of a random formula written from (x, y) and its right bound. Terms are separated by
+    operators and can be fractions or have a power """
+    chars = []
+    for term_index in range(length):
+        if term_index > 0:
+            operator = str(random.choice(list("+-*")))
+            chars.append(BenchmarkCharacter(operator, x, y - 0.2 * size, x + 0.6 * size, y + 0.2 * size))
+            x += 0.8 * size
+
+        if depth < 2 and random.random() < 0.2:
+            # Fraction of two smaller formulas
+            num, num_right = synthetic_formula(random, 2, x + 0.1 * size, y - 0.8 * size, 0.7 * size, depth + 1)
+            den, den_right = synthetic_formula(random, 2, x + 0.1 * size, y + 0.8 * size, 0.7 * size, depth + 1)
+            right = max(num_right, den_right) + 0.1 * size
+            chars += [BenchmarkCharacter('/', x, y - 0.05 * size, right, y + 0.05 * size)] + num + den
+            x = right + 0.2 * size
+        else:
+            # Number or variable, with an optional power
+            for prediction in str(random.choice(["1", "23", "X", "AB", "Y"])):
+                chars.append(BenchmarkCharacter(prediction, x, y - 0.5 * size, x + 0.7 * size, y + 0.5 * size))
+                x += 0.8 * size
+            if random.random() < 0.2:
+                chars.append(BenchmarkCharacter(str(random.choice(list("23"))), x, y - 1.1 * size, x + 0.4 * size,
+                                                y - 0.6 * size))
+                x += 0.5 * size
+
+    return chars, x
+
+
+def geometry_benchmark(formulas=200, length=8, runs=5):
+    """ Times the box geometry hot paths on synthetic formulas: grouping strokes into characters with a spatial
+    index, as Formula.add_line does, and building the parse trees """
+    random = np.random.default_rng(0)
+    formulas_chars = [synthetic_formula(random, length)[0] for _ in range(formulas)]
+    char_count = sum(len(chars) for chars in formulas_chars)
+
+    # Each character is drawn with two strokes covering its halves
+    strokes = [[Box(char.left, char.top, char.right, char.y), Box(char.left, char.y, char.right, char.bottom)]
+               for chars in formulas_chars for char in chars]
+
+    segmentation_times, parse_times = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for char_strokes in strokes:
+            index = GridIndex(64)
+            for stroke in char_strokes:
+                hit_boxes = index.query(stroke)
+                if len(hit_boxes) == 0:
+                    index.insert(Box(stroke))
+                else:
+                    hit_boxes[-1].merge_box(stroke)
+                    index.update(hit_boxes[-1])
+        segmentation_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for chars in formulas_chars:
+            fr.Expression(chars, ["AB", "X", "Y"])
+        parse_times.append(time.perf_counter() - start)
+
+    print("{} formulas, {} characters".format(formulas, char_count))
+    for stage, times in [("segmentation", segmentation_times), ("parse", parse_times)]:
+        print("{:>12}: {:.2f} us per character".format(stage, 1e6 * min(times) / char_count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless benchmarks of the OGMA pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ocr_parser = subparsers.add_parser("ocr", help="Replay DatabaseCreator rounds through the recognition pipeline")
+    ocr_parser.add_argument("rounds_directory")
+    ocr_parser.add_argument("--model", default=ir.default_model_path)
+    ocr_parser.add_argument("--batch-size", type=int, default=32)
+
+    canvas_parser = subparsers.add_parser("canvas", help="Compare segment and polyline stroke drawing")
+    canvas_parser.add_argument("--strokes", type=int, default=2000)
+    canvas_parser.add_argument("--points", type=int, default=60)
+    canvas_parser.add_argument("--runs", type=int, default=20)
+
+    geometry_parser = subparsers.add_parser("geometry", help="Time stroke segmentation and formula parsing")
+    geometry_parser.add_argument("--formulas", type=int, default=200)
+    geometry_parser.add_argument("--length", type=int, default=8)
+    geometry_parser.add_argument("--runs", type=int, default=5)
+
+    args = parser.parse_args()
+    if args.command == "ocr":
+        ocr_benchmark(args.rounds_directory, args.model, args.batch_size)
+    elif args.command == "canvas":
+        canvas_benchmark(args.strokes, args.points, args.runs)
+    else:
+        geometry_benchmark(args.formulas, args.length, args.runs)
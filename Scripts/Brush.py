@@ -1,10 +1,65 @@
+import math
 import tkinter as tk
 import numpy as np
-import numpy.linalg as lin
 
 from Draws import Line
 from Page import Book
 
+# Initial number of points of a line buffer
+POINT_BUFFER_SIZE = 64
+
+
+def simplify(points, tolerance):
+    """ Ramer-Douglas-Peucker simplification, keeps the points farther than tolerance from the simplified line """
+    if len(points) < 3:
+        return points
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    # Split segments until every point is close enough to its segment
+    segments = [(0, len(points) - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+
+        # Distances of the inner points to the segment
+        direction = points[last] - points[first]
+        inner = points[first + 1:last] - points[first]
+        length = math.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(direction[0] * inner[:, 1] - direction[1] * inner[:, 0]) / length
+
+        # Split on the farthest point
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            segments += [(first, middle), (middle, last)]
+
+    return points[keep]
+
+
+def resample(points, budget):
+    """ Resamples points evenly along the line arc length if there are more than budget points """
+    if len(points) <= budget:
+        return points
+
+    # Arc length at each point
+    steps = np.diff(points, axis=0)
+    arc_lengths = np.concatenate([[0], np.cumsum(np.hypot(steps[:, 0], steps[:, 1]))])
+
+    # Interpolate coordinates at evenly spaced arc lengths
+    targets = np.linspace(0, arc_lengths[-1], budget)
+    resampled = np.empty((budget, 2), dtype=np.float32)
+    resampled[:, 0] = np.interp(targets, arc_lengths, points[:, 0])
+    resampled[:, 1] = np.interp(targets, arc_lengths, points[:, 1])
+
+    return resampled
+
 
 class Brush:
     def __init__(self, canvas):
@@ -17,23 +72,32 @@ class Brush:
         self.color = "white"  # "#FFDFC8"
         self.capstyle = tk.ROUND
 
+        # Stroke simplification variables
+        self.simplify_tolerance = 1  # Max distance in pixels between raw and simplified line
+        self.point_budget = 64  # Max number of points of a line
+        self.keep_raw_points = False
+
         # Line variables
-        self.line_list = [0] * 256  # TODO manage list overflow
-        self.line_count = 0
+        self.line_id = None  # Canvas polyline of the current stroke
+        self.line_points = np.empty((POINT_BUFFER_SIZE, 2), dtype=np.float32)  # Growable stroke point buffer
+        self.line_count = 0  # Number of points in buffer
         self.line_x_min, self.line_x_max = 0, 0
         self.line_y_min, self.line_y_max = 0, 0
 
         # State variables
         self.is_drawing = False
-        self.last_point = np.zeros(2)
+        self.last_x, self.last_y = 0, 0
 
     def start_line(self, point):
         # Update focused canvas
         self.canvas = Book.canvas
 
-        # Set first line point
-        self.last_point[0] = point[0]
-        self.last_point[1] = point[1]
+        # Set first line point, in a new buffer as the previous one belongs to the previous line
+        self.last_x, self.last_y = point[0], point[1]
+        self.line_points = np.empty((POINT_BUFFER_SIZE, 2), dtype=np.float32)
+        self.line_count = 0
+        self.add_point(point[0], point[1])
+        self.line_id = None
 
         # Initialize boundary rectangle
         self.line_x_min = self.line_x_max = point[0]
@@ -42,47 +106,70 @@ class Brush:
         # Start drawing
         self.is_drawing = True
 
+    def add_point(self, x, y):
+        """ Appends a point to the line buffer, doubling its size when it is full """
+        if self.line_count == len(self.line_points):
+            points = np.empty((2 * len(self.line_points), 2), dtype=np.float32)
+            points[:self.line_count] = self.line_points
+            self.line_points = points
+
+        self.line_points[self.line_count] = x, y
+        self.line_count += 1
+
     def continue_line(self, point):
-        point = np.array(point)
+        x, y = point[0], point[1]
 
         # Check if we have to draw
-        if not self.is_drawing or lin.norm(point - self.last_point) < self.width * self.step:
+        if not self.is_drawing or math.hypot(x - self.last_x, y - self.last_y) < self.width * self.step:
             return
 
-        # Create line and store line ID in list
-        self.line_list[self.line_count] = self.canvas.create_line(self.last_point[0],
-                                                                  self.last_point[1],
-                                                                  point[0], point[1],
-                                                                  width=self.width,
-                                                                  fill=self.color,
-                                                                  capstyle=self.capstyle,
-                                                                  smooth=True)
-        self.line_count += 1
+        # Record stroke point
+        self.add_point(x, y)
+
+        # Create the stroke polyline on the first segment, then extend it
+        if self.line_id is None:
+            self.line_id = self.canvas.create_line(self.last_x, self.last_y, x, y,
+                                                   width=self.width,
+                                                   fill=self.color,
+                                                   capstyle=self.capstyle,
+                                                   joinstyle=tk.ROUND)
+        else:
+            self.canvas.insert(self.line_id, "end", (x, y))
 
         # Check for min and max
-        if point[0] - self.width / 2 < self.line_x_min:
-            self.line_x_min = point[0] - self.width / 2
-        if point[0] + self.width / 2 > self.line_x_max:
-            self.line_x_max = point[0] + self.width / 2
-        if point[1] - self.width / 2 < self.line_y_min:
-            self.line_y_min = point[1] - self.width / 2
-        if point[1] + self.width / 2 > self.line_y_max:
-            self.line_y_max = point[1] + self.width / 2
+        half_width = self.width / 2
+        if x - half_width < self.line_x_min:
+            self.line_x_min = x - half_width
+        if x + half_width > self.line_x_max:
+            self.line_x_max = x + half_width
+        if y - half_width < self.line_y_min:
+            self.line_y_min = y - half_width
+        if y + half_width > self.line_y_max:
+            self.line_y_max = y + half_width
 
         # Save last position
-        self.last_point[0] = point[0]
-        self.last_point[1] = point[1]
+        self.last_x, self.last_y = x, y
 
     def end_line(self):
         # Stop drawing
         self.is_drawing = False
 
+        # Simplify line points, raw points are a view on the line buffer
+        raw_points = self.line_points[:self.line_count]
+        points = resample(simplify(raw_points, self.simplify_tolerance), self.point_budget)
+
+        # Redraw line from simplified points
+        if self.line_id is not None and len(points) < len(raw_points):
+            self.canvas.coords(self.line_id, points.ravel().tolist())
+
         # Create line
-        new_line = Line(self.line_list[:self.line_count],
+        new_line = Line(self.line_id, points, self.width, self.color,
                         self.line_x_min, self.line_y_min, self.line_x_max, self.line_y_max)
+        if self.keep_raw_points:
+            new_line.raw_points = raw_points
 
-        # Reset line count
-        self.line_count = 0
+        # Reset line
+        self.line_id = None
 
         # Check line sanity
         if new_line.is_valid:
@@ -0,0 +1,107 @@
+import sys
+
+import Interpreter as ip
+
+# Memory budget of the undo/redo history of each page (bytes)
+HISTORY_SIZE = 8 * 1024 * 1024
+
+# Estimated memory footprint of a command record without its data (bytes)
+COMMAND_SIZE = 128
+
+
+class AddStroke:
+    def __init__(self, line, page, declared):
+        """ Stroke drawn on the page, declared is False if the stroke was drawn in free mode """
+        self.line = line
+        self.page = page
+        self.declared = declared
+
+    def undo(self):
+        self.line.delete()
+
+    def redo(self):
+        # Hibernating pages forget their deleted lines, which still refer to the canvas the page had then
+        if self.line not in self.page.lines:
+            self.page.lines.append(self.line)
+        self.line.canvas = self.page.canvas
+
+        # Redraw stroke and segment it again
+        self.line.restore()
+        if self.declared:
+            self.page.blackboard.add_line(self.line)
+
+    def size(self):
+        return COMMAND_SIZE + self.line.points.nbytes
+
+
+class DeleteStroke(AddStroke):
+    def undo(self):
+        super().redo()
+
+    def redo(self):
+        super().undo()
+
+
+class CorrectPrediction:
+    def __init__(self, page, corrections):
+        """ Predictions corrected by hand, corrections is a list of (line, (old prediction, old is_corrected),
+        (new prediction, new is_corrected)). Characters are merged, split and recreated by later strokes, so each one
+        is found again on the page from one of its lines """
+        self.page = page
+        self.corrections = corrections
+
+    def undo(self):
+        self.set_predictions([(line, old_state) for line, old_state, _ in self.corrections])
+
+    def redo(self):
+        self.set_predictions([(line, new_state) for line, _, new_state in self.corrections])
+
+    def set_predictions(self, states):
+        updated_formulas = []
+        for line, (prediction, is_corrected) in states:
+            formula, char = self.find_character(line)
+
+            # The character was erased since
+            if char is None:
+                continue
+
+            char.prediction, char.is_corrected = prediction, is_corrected
+            if formula not in updated_formulas:
+                updated_formulas.append(formula)
+
+        for formula in updated_formulas:
+            formula.update_representation()
+
+    def find_character(self, line):
+        """ Returns the formula and the character line currently belongs to, (None, None) if it was erased """
+        for formula in self.page.blackboard.formulas:
+            for char in formula.chars:
+                if line in char.lines:
+                    return formula, char
+        return None, None
+
+    def size(self):
+        return COMMAND_SIZE + sys.getsizeof(self.corrections)
+
+
+class Evaluate:
+    def __init__(self, state_before, state_after):
+        """ Formula evaluation, states are the interpreter variables given by Interpreter.get_state """
+        self.state_before = state_before
+        self.state_after = state_after
+
+    def undo(self):
+        ip.set_state(self.state_before)
+
+    def redo(self):
+        ip.set_state(self.state_after)
+
+    def size(self):
+        return COMMAND_SIZE + state_size(self.state_before) + state_size(self.state_after)
+
+
+def state_size(state):
+    """ Returns the estimated memory footprint of an interpreter state: its dicts with their keys and values """
+    return sum(sys.getsizeof(variables) + sum(sys.getsizeof(key) + sys.getsizeof(value)
+                                              for key, value in variables.items()) for variables in state)
+
@@ -1,16 +1,108 @@
-from collections import deque
+from collections import OrderedDict, deque
 
 
-class Deque:
-    def __init__(self, length):
-        self.deque = deque([None for i in range(length)])
+class CommandLog:
+    def __init__(self, max_size):
+        """ Undo/redo history. Commands have undo, redo and size methods, size being their memory footprint in bytes.
+        The oldest commands are forgotten once the history is bigger than max_size """
+        self.max_size = max_size
+        self.size = 0
 
-    def put(self, x):
-        self.deque.rotate(-1)
-        self.deque[-1] = x
+        # (command, size) done and undone stacks
+        self.done = deque()
+        self.undone = []
 
-    def get(self):
-        x = self.deque[-1]
-        self.deque[-1] = None
-        self.deque.rotate(1)
-        return x
+    def record(self, command):
+        """ Records a command which was just done, the undone commands can't be redone anymore """
+        size = command.size()
+        self.done.append((command, size))
+        self.size += size
+
+        # Forget undone commands
+        self.size -= sum(size for _, size in self.undone)
+        self.undone.clear()
+
+        # Forget the oldest commands, but always keep the last one
+        while self.size > self.max_size and len(self.done) > 1:
+            _, size = self.done.popleft()
+            self.size -= size
+
+    def undo(self):
+        if len(self.done) == 0:
+            return None
+
+        command, size = self.done.pop()
+        command.undo()
+        self.undone.append((command, size))
+        return command
+
+    def redo(self):
+        if len(self.undone) == 0:
+            return None
+
+        command, size = self.undone.pop()
+        command.redo()
+        self.done.append((command, size))
+        return command
+
+    def clear(self):
+        self.done.clear()
+        self.undone.clear()
+        self.size = 0
+
+
+class CommandGroup:
+    def __init__(self, commands):
+        """ Commands undone and redone in one step """
+        self.commands = commands
+
+    def undo(self):
+        for command in reversed(self.commands):
+            command.undo()
+
+    def redo(self):
+        for command in self.commands:
+            command.redo()
+
+    def size(self):
+        return sum(command.size() for command in self.commands)
+
+
+class LRUCache:
+    def __init__(self, max_size, count_hits=False):
+        """ Mapping keeping its max_size most recently used entries. With count_hits, lookups are counted as hits
+        or misses """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.count_hits = count_hits
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        """ Returns the value of key or None, key becomes the most recently used """
+        if key not in self.entries:
+            if self.count_hits:
+                self.misses += 1
+            return None
+
+        if self.count_hits:
+            self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+        # Forget the least recently used entry
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits, self.misses = 0, 0
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "max_size": self.max_size}
+
+    def __len__(self):
+        return len(self.entries)
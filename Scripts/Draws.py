@@ -6,10 +6,29 @@ from Page import Book
 import FormulaRepresentation as fr
 import Interpreter as ip
 from ExpressionTypes import *
+from SpatialIndex import GridIndex
+from Commands import CorrectPrediction
+
+# Pending prediction display and outline of formulas waiting for it, left unchanged when typed in a formula entry
+PENDING_PREDICTION = '?'
+PENDING_COLOR = "orange"
+
+# Outline of formulas with characters which couldn't be recognized
+FAILED_COLOR = "red"
+
+# Formula entry key bindings: symbol switching a character to its next most probable candidate
+NEXT_CANDIDATE = '~'
+
+# Spatial index cell sizes in pixels
+CHARACTER_CELL_SIZE = 64
+FORMULA_CELL_SIZE = 256
 
 
 class Line(Box):
-    def __init__(self, line_ids, x1, y1, x2, y2):
+    __slots__ = ("is_valid", "aspect_ratio", "canvas", "line_id", "points", "raw_points", "stroke_width", "color",
+                 "delete_callback")
+
+    def __init__(self, line_id, points, stroke_width, color, x1, y1, x2, y2):
         # Super class init
         super().__init__(x1, y1, x2, y2)
 
@@ -22,16 +41,24 @@ class Line(Box):
         else:
             self.aspect_ratio = None
 
-        # Save line IDs
-        self.line_ids = line_ids
+        # Save canvas and polyline ID (None if the stroke has no segment)
+        self.canvas = Book.canvas
+        self.line_id = line_id
+
+        # Save stroke points and width (used to rasterize the character offscreen)
+        self.points = points
+        self.raw_points = None  # Points before simplification, if kept by the brush
+        self.stroke_width = stroke_width
+        self.color = color
 
         # Initialize delete callback
         self.delete_callback = lambda: None
 
     def delete(self):
-        # Delete lines
-        for line_id in self.line_ids:
-            Book.canvas.delete(line_id)
+        # Delete polyline
+        if self.line_id is not None:
+            self.canvas.delete(self.line_id)
+            self.line_id = None
 
         # Line not valid anymore
         self.is_valid = False
@@ -39,13 +66,47 @@ class Line(Box):
         # Call delete callback
         self.delete_callback()
 
+    def draw(self):
+        self.line_id = self.canvas.create_line(self.points.ravel().tolist(),
+                                               width=self.stroke_width,
+                                               fill=self.color,
+                                               capstyle=tk.ROUND,
+                                               joinstyle=tk.ROUND)
+
+    def restore(self):
+        """ Draws a deleted line again from its points """
+        self.draw()
+        self.is_valid = True
+        self.delete_callback = lambda: None
+
+    def hibernate(self):
+        # The canvas is about to be destroyed with its items
+        self.canvas = None
+        self.line_id = None
+        self.raw_points = None
+
+    def wake(self, canvas):
+        self.canvas = canvas
+        self.draw()
+
 
 class Character(Box):
+    __slots__ = ("lines", "prediction", "candidates", "is_pending", "is_corrected", "prediction_callback")
+
     def __init__(self, line):
         # Initialize class instance
         super().__init__(line)
         self.lines = [line]
-        self.prediction = ir.predict(self)
+        self.prediction = None
+        self.candidates = []  # (label, probability) list sorted by decreasing probability
+        self.is_pending = False
+        self.is_corrected = False  # Prediction set by hand, context rules don't change it
+
+        # Initialize prediction callback, called each time a new prediction is given
+        self.prediction_callback = lambda char: None
+
+        # Ask for a prediction
+        self.predict()
 
     def add_line(self, new_line):
         # Add new line to line list
@@ -58,18 +119,73 @@ class Character(Box):
         self.predict()
 
     def predict(self):
-        self.prediction = ir.predict(self)
+        # Character is pending until its prediction is given, recognition waits for the end of the glyph
+        self.is_pending = True
+        ir.schedule_prediction(self)
+
+    def set_prediction(self, candidates):
+        self.candidates = candidates
+        self.prediction = candidates[0][0]
+        self.is_pending = False
+        self.is_corrected = False
+        self.prediction_callback(self)
+
+    def set_prediction_failed(self):
+        """ Recognition failed, the character has no prediction until it is corrected by hand """
+        self.candidates = []
+        self.prediction = None
+        self.is_pending = False
+        self.prediction_callback(self)
+
+    def correct(self, prediction):
+        """ Sets the prediction by hand """
+        self.prediction = prediction
+        self.is_corrected = True
+
+    def switch_prediction(self, condition, fallback=None):
+        """ Switches the prediction to the most probable candidate satisfying condition, or to fallback if no
+        candidate does """
+        for label, _ in self.candidates:
+            if condition(label):
+                self.prediction = label
+                return
+
+        if fallback is not None:
+            self.prediction = fallback
+
+    def next_prediction(self):
+        """ Switches the prediction to the next most probable candidate """
+        labels = [label for label, _ in self.candidates]
+        if self.prediction in labels:
+            self.prediction = labels[(labels.index(self.prediction) + 1) % len(labels)]
+
+    @property
+    def confidence(self):
+        """ Probability of the current prediction, None if it isn't a candidate """
+        return next((probability for label, probability in self.candidates if label == self.prediction), None)
 
     def absorb(self, char):
-        for line in char.lines:
+        for line in char.lines.copy():
             self.lines.append(line)
             char.lines.remove(line)
 
+        # Recompute bounds
+        self.merge_box(char)
+
     def clean(self):
-        for line in self.lines:
-            if not line.is_valid:
-                self.lines.remove(line)
-                del line
+        """ Removes the deleted lines, then recomputes bounds and prediction of the lines left """
+        lines = [line for line in self.lines if line.is_valid]
+        if len(lines) == len(self.lines):
+            return
+
+        self.lines = lines
+        if len(lines) > 0:
+            box = Box(lines[0])
+            for line in lines[1:]:
+                box.merge_box(line)
+            self.set_box(box)
+
+            self.predict()
 
     def get_type(self):
         if is_digit(self.prediction):
@@ -84,69 +200,182 @@ class Character(Box):
             raise AttributeError("Character " + self.prediction + " doesnt exists")
 
     def __str__(self):
+        if self.prediction is None:
+            return PENDING_PREDICTION
         return self.prediction
 
 
 class Formula(Box):
+    # Pen idle time in ms before a full reparse
+    reparse_delay = 300
+
     def __init__(self, line):
         # Initialize class instance
         super().__init__(line)
 
-        # Initialize characters list
+        # Initialize characters list and their spatial index
         self.chars = []
+        self.char_index = GridIndex(CHARACTER_CELL_SIZE)
+
+        # Initialize equation parse tree, rebuilt when the characters it depends on change
+        self.equation = None
+        self.parse_key = None
+        self.reparse_job = None
 
+        # Initialize rectangle and entry
+        self.canvas = Book.canvas
+        self.entry_text = tk.StringVar()
+        self.create_widgets()
+
+        # Add first line
+        self.add_line(line)
+
+    def create_widgets(self):
         # Initialize rectangle
-        self.rectangle = Book.canvas.create_rectangle(0, 0, 0, 0, outline="green")
+        self.rectangle = self.canvas.create_rectangle(0, 0, 0, 0, outline="green")
 
         # Initialize entry
-        self.entry_text = tk.StringVar()
-        self.entry = tk.Entry(Book.canvas, textvariable=self.entry_text, font="Calibri 20")
+        self.entry = tk.Entry(self.canvas, textvariable=self.entry_text, font="Calibri 20")
         self.entry.place(height=30)
         self.entry.bind("<Return>", lambda event: self.update_prediction())
 
-        # Add first line
-        self.add_line(line)
+    def hibernate(self):
+        """ Cancels the formula pending work before its canvas is destroyed with its widgets """
+        self.cancel_reparse()
+        for char in self.chars:
+            if char.is_pending:
+                ir.cancel_prediction(char)
+
+        self.canvas = None
+        self.rectangle = None
+        self.entry = None
+
+    def wake(self, canvas):
+        """ Draws the formula again on a new canvas and resumes its pending work """
+        self.canvas = canvas
+        self.create_widgets()
+        self.canvas.coords(self.rectangle, *self.get_bounds())
+
+        # Predict again the characters whose prediction was cancelled
+        for char in self.chars:
+            if char.is_pending:
+                char.predict()
+
+        # Parse tree may be outdated
+        self.parse_key = None
+        self.update_representation()
 
-    def add_line(self, new_line):  # TODO Not clean
-        if len(self.chars) == 0 or not self.chars[-1].is_intersecting(new_line):
+    def add_line(self, new_line):
+        # Look for the characters hit by the new line
+        hit_chars = self.char_index.query(new_line)
+
+        if len(hit_chars) == 0:
             # Create new character in formula
             last_char = Character(new_line)
+            last_char.prediction_callback = lambda char: self.new_prediction()
             self.chars.append(last_char)
+            self.char_index.insert(last_char)
         else:
-            # Add new line to last character
-            last_char = self.chars[-1]
+            # Add new line to the most recent hit character
+            last_char = hit_chars[-1]
             last_char.add_line(new_line)
-
-        # Run confusion avoidance check
-        self.avoid_confusion()
+            self.char_index.update(last_char)
 
         # Recompute bounds and add extra space
-        x_min = min(self.center[0] - 0.5 * self.width, last_char.center[0] - 0.75 * last_char.width)
-        x_max = max(self.center[0] + 0.5 * self.width, last_char.center[0] + 2.0 * last_char.width)
-        y_min = min(self.center[1] - 0.5 * self.height, last_char.center[1] - 1.5 * last_char.height)
-        y_max = max(self.center[1] + 0.5 * self.height, last_char.center[1] + 1.5 * last_char.height)
+        x_min = min(self.x - 0.5 * self.width, last_char.x - 0.75 * last_char.width)
+        x_max = max(self.x + 0.5 * self.width, last_char.x + 2.0 * last_char.width)
+        y_min = min(self.y - 0.5 * self.height, last_char.y - 1.5 * last_char.height)
+        y_max = max(self.y + 0.5 * self.height, last_char.y + 1.5 * last_char.height)
 
         # Update box parameters
-        self.center = [0.5 * (x_min + x_max), 0.5 * (y_min + y_max)]
+        self.x, self.y = 0.5 * (x_min + x_max), 0.5 * (y_min + y_max)
         self.width = x_max - x_min
         self.height = y_max - y_min
 
         # Update rectangles
-        Book.canvas.coords(self.rectangle, x_min, y_min, x_max, y_max)
+        self.canvas.coords(self.rectangle, x_min, y_min, x_max, y_max)
 
         # Update entry
-        #self.entry.place(x=self.center[0] - 0.5 * self.width, y=self.center[1] + 0.6 * self.height)
+        #self.entry.place(x=self.x - 0.5 * self.width, y=self.y + 0.6 * self.height)
         #self.entry_text.set(fr.get_python_rpz(self, ip.get_variable_names()))  TODO REMOOOOOOOVE
 
-        _ = fr.get_python_expression(self, ip.get_variable_names())
+        self.update_representation()
+
+    def update_representation(self):
+        # Wait for every character prediction, and for the correction of the ones which couldn't be recognized
+        if any(char.is_pending for char in self.chars):
+            self.canvas.itemconfig(self.rectangle, outline=PENDING_COLOR)
+            return
+        if not self.is_predicted():
+            self.canvas.itemconfig(self.rectangle, outline=FAILED_COLOR)
+            return
+        self.canvas.itemconfig(self.rectangle, outline="green")
+
+        # The parse tree only has to be rebuilt when the characters or their predictions changed
+        if self.get_parse_key() != self.parse_key:
+            self.schedule_reparse()
+
+    def new_prediction(self):
+        """ Called each time one of the characters is given a prediction """
+        # Run confusion avoidance check
+        if self.is_predicted():
+            self.avoid_confusion()
+
+        self.update_representation()
+
+    def get_parse_key(self):
+        """ Returns what the parse tree depends on: characters bounds and predictions, and the interpreter symbol
+        table version """
+        chars_key = tuple((char, char.get_bounds(), char.prediction) for char in self.chars)
+        return chars_key, ip.version
+
+    def schedule_reparse(self):
+        """ Reparses the formula once the pen has been idle for reparse_delay """
+        self.cancel_reparse()
+        self.reparse_job = self.canvas.after(self.reparse_delay, self.reparse)
+
+    def cancel_reparse(self):
+        if self.reparse_job is not None:
+            self.canvas.after_cancel(self.reparse_job)
+            self.reparse_job = None
+
+    def reparse(self):
+        self.reparse_job = None
+        if len(self.chars) == 0 or not self.is_predicted():
+            return
+
+        # The formula may still be incomplete, parse errors are raised when it is evaluated
+        try:
+            self.parse()
+        except (AssertionError, IndexError, StopIteration):
+            self.parse_key = self.get_parse_key()
+
+    def parse(self):
+        self.equation = None
+        self.equation = fr.get_python_equation(self, ip.get_variable_names(), ip.version)
+
+        # Horizontal lines classification may have changed predictions
+        self.parse_key = self.get_parse_key()
+
+    def get_equation(self):
+        """ Returns the equation parse tree, parsed right away if the kept one is outdated or couldn't be built """
+        self.cancel_reparse()
+        if self.equation is None or self.get_parse_key() != self.parse_key:
+            self.parse()
+        return self.equation
+
+    def is_predicted(self):
+        return all(not char.is_pending and char.prediction is not None for char in self.chars)
 
     def avoid_confusion(self):
         # If length is lower than two, no confusion is avoidable
         if len(self.chars) < 2:
             return
 
-        # Get two last characters
+        # Get two last characters, predictions corrected by hand are kept
         char, p_char = self.chars[-1], self.chars[-2]
+        if char.is_corrected or p_char.is_corrected:
+            return
 
         # Check if the last two characters are -- and are more or less on the same vertical axis,
         # make it a =
@@ -154,45 +383,70 @@ class Formula(Box):
             if abs(char.width - p_char.width) / min(char.width, p_char.width) < 0.4:
                 p_char.absorb(char)
                 p_char.prediction = '='
+                p_char.candidates = [('=', 1.0)]
                 self.chars.remove(char)
+                self.char_index.remove(char)
+                self.char_index.update(p_char)
+                ir.cancel_prediction(char)
 
         # Check if the last two characters are a letter and 0 (not possible) to avoid 0 and O confusion
+        # Use the most probable letter, O by default
         elif char.prediction == '0' and is_letter(p_char.prediction):
-            char.prediction = 'O'
+            char.switch_prediction(is_letter, 'O')
 
         # Check if the last two characters are a letter and 5 (not possible) to avoid 5 and S confusion
+        # Use the most probable letter, S by default
         elif char.prediction == '5' and is_letter(p_char.prediction):
-            char.prediction = 'S'
+            char.switch_prediction(is_letter, 'S')
 
     def __str__(self):
         prediction = ""
         for char in self.chars:
-            prediction += char.prediction
+            prediction += str(char)
         return prediction
 
     def clean(self):
         # Delete empty characters
-        for char in self.chars:
+        for char in self.chars.copy():
             char.clean()
             if len(char.lines) == 0:
                 self.chars.remove(char)
+                self.char_index.remove(char)
+                ir.cancel_prediction(char)
                 del char
+            else:
+                self.char_index.update(char)
 
         # If formula is empty, delete rectangle
         if len(self.chars) == 0:
-            Book.canvas.delete(self.rectangle)
+            self.cancel_reparse()
+            self.canvas.delete(self.rectangle)
             self.entry.destroy()
+        else:
+            self.update_representation()
 
     def update_prediction(self):
         # Check that the character number is correct
         new_prediction = self.entry_text.get()
         if len(new_prediction) == len(self.chars):
-            # Length is correct
+            # Length is correct, the next candidate symbol asks for the next candidate
+            old_states = [(char.prediction, char.is_corrected) for char in self.chars]
             for i in range(len(self.chars)):
-                self.chars[i].prediction = new_prediction[i]
+                if new_prediction[i] == NEXT_CANDIDATE:
+                    self.chars[i].next_prediction()
+                    self.chars[i].is_corrected = True
+                elif new_prediction[i] not in [PENDING_PREDICTION, self.chars[i].prediction]:
+                    self.chars[i].correct(new_prediction[i])
+
+            # Save corrections to undo them later
+            corrections = [(char.lines[0], old_state, (char.prediction, char.is_corrected))
+                           for char, old_state in zip(self.chars, old_states) if char.prediction != old_state[0]]
+            if len(corrections) > 0:
+                Book.history.record(CorrectPrediction(Book.page, corrections))
+                self.update_representation()
         else:
             # Length isn't correct
-            self.entry_text.set(self.get_prediction())
+            self.entry_text.set(str(self))
 
         # Stop focusing entry
         Book.canvas.focus_set()
@@ -201,17 +455,19 @@ class Formula(Box):
 class BlackBoard:
     def __init__(self):
         self.formulas = []
+        self.formula_index = GridIndex(FORMULA_CELL_SIZE)
 
     def add_line(self, new_line):
-        # TODO currently: only the last formula
-
-        # If the new line intersects an existing formula, add the new line to this formula
-        if len(self.formulas) > 0 and self.formulas[-1].is_intersecting(new_line):
-            last_formula = self.formulas[-1]
+        # If the new line intersects existing formulas, add the new line to the most recent one
+        hit_formulas = self.get_formulas_at(new_line)
+        if len(hit_formulas) > 0:
+            last_formula = hit_formulas[-1]
             last_formula.add_line(new_line)
+            self.formula_index.update(last_formula)
         else:
             last_formula = Formula(new_line)
             self.formulas.append(last_formula)
+            self.formula_index.insert(last_formula)
 
         # Assign line delete callback to formula.clean
         new_line.delete_callback = lambda: self.clean_formula(last_formula)
@@ -220,11 +476,12 @@ class BlackBoard:
         formula.clean()
         if len(formula.chars) == 0:
             self.formulas.remove(formula)
+            self.formula_index.remove(formula)
 
-    def get_last_formula(self):
-        # TODO currently: only the last formula
+    def get_formulas_at(self, box):
+        """ Returns the formulas intersecting box, sorted by creation order """
+        return self.formula_index.query(box)
 
-        if len(self.formulas) > 0:
-            return self.formulas[-1]
-        else:
-            return None
+    def get_nearest_formula(self, x, y):
+        """ Returns the formula nearest to (x, y), None if the blackboard is empty """
+        return self.formula_index.nearest(x, y)
@@ -1,9 +1,27 @@
+import ast
+from bisect import bisect_left, bisect_right
 from re import finditer
 from Box import Box
+from CustomQueues import LRUCache
 from ExpressionTypes import *
 
+# Number of parsed expressions and equations kept
+PARSE_CACHE_SIZE = 64
+
+# Formulas with at most this number of characters are classified without interval index
+LINEAR_SCAN_SIZE = 128
+
+# Adjacent group types multiplied without product sign
+IMPLICIT_PRODUCTS = [{DIGIT, LETTER}, {DIGIT, FRACTION}, {LETTER, FRACTION}, {LETTER, LETTER}]
+
+# Operators by precedence level
+SUM_OPERATORS = {"+": ast.Add, "-": ast.Sub}
+PRODUCT_OPERATORS = {"*": ast.Mult, "/": ast.Div, "//": ast.FloorDiv}
+UNARY_OPERATORS = {"+": ast.UAdd, "-": ast.USub}
+
 
 class Group(Box):
+    __slots__ = ("chars", "pow", "type")
 
     def __init__(self, *args):
 
@@ -58,8 +76,40 @@ class Group(Box):
 
         return s
 
+    def get_ast(self):
+        """ Returns the Python ast node of an operand group: a name, a number or a fraction, raised to its power """
+        if self.type == LETTER:
+            node = ast.Name("".join(str(char) for char in self.chars), ast.Load())
+        elif self.type == DIGIT:
+            number = "".join(str(char) for char in self.chars)
+            if number[0] == '0' and number.strip('0') != "":
+                raise SyntaxError("Leading zeros in " + number)
+            node = ast.Constant(int(number))
+        elif self.type == FRACTION:
+            node = self.chars[0].get_ast()
+        else:
+            raise SyntaxError("Unexpected " + str(self))
+
+        if self.pow:
+            node = ast.BinOp(node, ast.Pow(), self.pow.get_ast())
+
+        return node
+
+    def get_predictions(self):
+        """ Returns the predictions of the characters of the group and of its power, which its code depends on """
+        if self.type == FRACTION:
+            predictions = self.chars[0].get_predictions()
+        else:
+            predictions = [char.prediction for char in self.chars]
+
+        if self.pow:
+            predictions += self.pow.get_predictions()
+        return predictions
+
 
 class Expression(Box):
+    __slots__ = ("base", "variables", "code", "code_predictions")
+
     def __init__(self, formula_chars, variables):
         """ When an expression is created, a list of characters is given. Then we look for divisions. If a division
         is in the list, we create the widest division possible. Then we check if another division is still in the list
@@ -72,6 +122,8 @@ class Expression(Box):
         # Class attributes
         self.base = []          # Character and fractions list
         self.variables = set()  # Variables in expression
+        self.code = None        # Compiled expression, built on first evaluation
+        self.code_predictions = None  # Predictions the code was compiled from
 
         # Initialize box
         group_box = Box(chars[0])
@@ -80,29 +132,9 @@ class Expression(Box):
 
         super().__init__(group_box)
 
-        # Initialization
-        preds = [char.prediction for char in chars]
-
         # Create fractions
-        while '/' in preds:
-            # Get every divide character sorted by length and get the widest
-            divides = [char for char in chars if char.prediction == '/']
-            divides.sort(key=lambda x: x.width)
-            divide = divides[-1]
-
-            # Create list with every other elements
-            char_list = chars.copy()
-            char_list.remove(divide)
-
-            # Isolate characters above and below
-            above, below = [], []
-            for c in char_list:
-                if c.right > divide.left and c.left < divide.right:
-                    if c.y <= divide.y:
-                        above.append(c)
-                    else:
-                        below.append(c)
-
+        fractions, chars = split_fractions(chars)
+        for above, below in fractions:
             # If no list is empty, create fraction and add it to expression
             if len(above) > 0 and len(below) > 0:
                 above_exp, below_exp = Expression(above, variables), Expression(below, variables)
@@ -116,15 +148,6 @@ class Expression(Box):
                 else:
                     self.base += below
 
-            # Remove elements in the new fraction
-            for c in above + below:
-                chars.remove(c)
-            # Remove divide
-            chars.remove(divide)
-
-            # Update preds for the next loop
-            preds = [char.prediction for char in chars]
-
         # Add each character left and sort them by x position
         self.base += chars
         self.base.sort(key=lambda e: e.x)
@@ -184,7 +207,7 @@ class Expression(Box):
 
         for i in range(1, len(self.base)):
             group = self.base[i]
-            if {p_group.type, group.type} in [{DIGIT, LETTER}, {DIGIT, FRACTION}, {LETTER, FRACTION}, {LETTER, LETTER}]:
+            if {p_group.type, group.type} in IMPLICIT_PRODUCTS:
                 out += "*"
 
             out += str(group)
@@ -193,8 +216,32 @@ class Expression(Box):
 
         return parenthesis_fix(out)
 
+    def get_ast(self):
+        """ Returns the Python ast node of the expression, built from its groups """
+        items = read_parentheses(self.base)
+        node, position = parse_sum(items, 0)
+        if position != len(items):
+            raise SyntaxError("Unexpected " + str(items[position]))
+        return node
+
+    def get_predictions(self):
+        predictions = []
+        for group in self.base:
+            predictions += group.get_predictions()
+        return predictions
+
+    def compile(self):
+        """ Returns the code object evaluating the expression, compiled again if a prediction changed since """
+        predictions = self.get_predictions()
+        if self.code is None or self.code_predictions != predictions:
+            self.code = compile_ast(self.get_ast())
+            self.code_predictions = predictions
+        return self.code
+
 
 class Fraction(Box):
+    __slots__ = ("num", "den")
+
     def __init__(self, num, den):
         self.num = num  # Num expression
         self.den = den  # Den expression
@@ -210,6 +257,12 @@ class Fraction(Box):
     def __str__(self):
         return "(" + str(self.num) + ")/(" + str(self.den) + ")"
 
+    def get_ast(self):
+        return ast.BinOp(self.num.get_ast(), ast.Div(), self.den.get_ast())
+
+    def get_predictions(self):
+        return self.num.get_predictions() + self.den.get_predictions()
+
 
 class Equation:
     def __init__(self, formula_chars, variables):
@@ -234,10 +287,274 @@ class Equation:
 
         # Create expressions
         self.left, self.right = Expression(left_chars, variables), Expression(right_chars, variables)
+        self.difference_code = None  # Compiled left side - right side
+        self.difference_predictions = None  # Predictions the difference code was compiled from
 
     def __str__(self):
         return str(self.left) + '=' + str(self.right)  # TODO REMOVE PARENTHESIS_FIX
 
+    def compile_difference(self):
+        """ Returns the code object evaluating left side - right side, compiled again if a prediction changed since """
+        predictions = self.left.get_predictions(), self.right.get_predictions()
+        if self.difference_code is None or self.difference_predictions != predictions:
+            self.difference_code = compile_ast(ast.BinOp(self.left.get_ast(), ast.Sub(), self.right.get_ast()))
+            self.difference_predictions = predictions
+        return self.difference_code
+
+
+def read_parentheses(groups):
+    """ Returns the items the ast is built from: the groups, with Parenthesis items for the parentheses. Like
+    parenthesis_fix, lone 1 digits in * 1 * ... * 1 patterns with minimal content are read as parentheses, and the
+    products before them and after the opening one are removed """
+    # Pair the 1 digits read as parentheses
+    pairs = []
+    i = 0
+    while i < len(groups):
+        if is_lone_one(groups[i]) and groups[i].pow is None and is_product_before(groups, i) and \
+                is_product_after(groups, i):
+            content_start = i + 2 if is_star(groups, i + 1) else i + 1
+            closing = next((j for j in range(content_start + 1, len(groups))
+                            if is_lone_one(groups[j]) and is_product_before(groups, j) and
+                            (j - 1 if is_star(groups, j - 1) else j) > content_start), None)
+            if closing is not None:
+                pairs.append((i, closing))
+                i = closing + 1
+                continue
+        i += 1
+
+    # Replace them by parentheses and remove the explicit products around
+    openings, closings, removed = set(), set(), set()
+    for opening, closing in pairs:
+        openings.add(opening)
+        closings.add(closing)
+        removed |= {k for k in [opening - 1, opening + 1, closing - 1] if is_star(groups, k)}
+
+    items = []
+    for i, group in enumerate(groups):
+        if i in openings:
+            items.append(Parenthesis('('))
+        elif i in closings:
+            # Products following the 1 are kept
+            items.append(Parenthesis(')', group.pow, DIGIT))
+        elif group.type == PARENTHESIS:
+            items.append(Parenthesis(str(group.chars[0]), group.pow))
+        elif i not in removed:
+            items.append(group)
+
+    return items
+
+
+def is_lone_one(group):
+    return group.type == DIGIT and len(group.chars) == 1 and str(group.chars[0]) == '1'
+
+
+def is_star(groups, i):
+    return 0 <= i < len(groups) and groups[i].type == MATH and str(groups[i].chars[0]) == '*'
+
+
+def is_product_before(groups, i):
+    """ Checks if the group i is multiplied by the previous one, explicitly or implicitly """
+    return i > 0 and (is_star(groups, i - 1) or {groups[i - 1].type, groups[i].type} in IMPLICIT_PRODUCTS)
+
+
+def is_product_after(groups, i):
+    return i + 1 < len(groups) and (is_star(groups, i + 1) or {groups[i].type, groups[i + 1].type} in IMPLICIT_PRODUCTS)
+
+
+class Parenthesis:
+    __slots__ = ("symbol", "pow", "type")
+
+    def __init__(self, symbol, power=None, group_type=PARENTHESIS):
+        """ Parenthesis item of an expression, closing ones carry the power of the parenthesized expression. A 1
+        read as closing parenthesis keeps the digit type so that it is still multiplied by the next group """
+        self.symbol = symbol
+        self.pow = power
+        self.type = group_type
+
+    def __str__(self):
+        return self.symbol
+
+
+def parse_sum(items, i):
+    """ Builds the ast of the sum starting at item i following Python precedence, returns the node and the
+    position of the first item left """
+    node, i = parse_product(items, i)
+    operator, next_i = get_operator(items, i)
+    while operator in SUM_OPERATORS:
+        right, i = parse_product(items, next_i)
+        node = ast.BinOp(node, SUM_OPERATORS[operator](), right)
+        operator, next_i = get_operator(items, i)
+
+    return node, i
+
+
+def parse_product(items, i):
+    node, i = parse_unary(items, i)
+    while True:
+        operator, next_i = get_operator(items, i)
+        if operator in PRODUCT_OPERATORS:
+            right, i = parse_unary(items, next_i)
+            node = ast.BinOp(node, PRODUCT_OPERATORS[operator](), right)
+        elif is_implicit_product(items, i):
+            right, i = parse_unary(items, i)
+            node = ast.BinOp(node, ast.Mult(), right)
+        else:
+            return node, i
+
+
+def parse_unary(items, i):
+    operator, next_i = get_operator(items, i)
+    if operator in UNARY_OPERATORS:
+        operand, i = parse_unary(items, next_i)
+        return ast.UnaryOp(UNARY_OPERATORS[operator](), operand), i
+
+    return parse_power(items, i)
+
+
+def parse_power(items, i):
+    node, i = parse_call(items, i)
+    operator, next_i = get_operator(items, i)
+    if operator == "**":
+        exponent, i = parse_unary(items, next_i)
+        node = ast.BinOp(node, ast.Pow(), exponent)
+
+    return node, i
+
+
+def parse_call(items, i):
+    """ Operands followed by parentheses are called with their content """
+    node, i = parse_atom(items, i)
+    while is_parenthesis_item(items, i, '('):
+        argument, power, i = parse_parenthesis(items, i)
+        node = ast.Call(node, [] if argument is None else [argument], [])
+        if power:
+            node = ast.BinOp(node, ast.Pow(), power.get_ast())
+
+    return node, i
+
+
+def parse_atom(items, i):
+    if i >= len(items):
+        raise SyntaxError("Unexpected end of expression")
+
+    if is_parenthesis_item(items, i, '('):
+        node, power, i = parse_parenthesis(items, i)
+        if node is None:
+            raise SyntaxError("Empty parentheses")
+        if power:
+            node = ast.BinOp(node, ast.Pow(), power.get_ast())
+        return node, i
+
+    if isinstance(items[i], Group):
+        return items[i].get_ast(), i + 1
+
+    raise SyntaxError("Unexpected " + str(items[i]))
+
+
+def parse_parenthesis(items, i):
+    """ Builds the ast of the content of the parenthesis opening at item i, None if it is empty. Returns it with the
+    power of the closing parenthesis and the position after it """
+    if items[i].pow:
+        raise SyntaxError("Unexpected power of (")
+
+    node, i = (None, i + 1) if is_parenthesis_item(items, i + 1, ')') else parse_sum(items, i + 1)
+    if not is_parenthesis_item(items, i, ')'):
+        raise SyntaxError("Expected )")
+
+    return node, items[i].pow, i + 1
+
+
+def get_operator(items, i):
+    """ Returns the operator of the math item i and the position after it, (None, i) if item i isn't one. Doubled *
+    and / are read as ** and // like the Python tokenizer does """
+    if i >= len(items) or items[i].type != MATH:
+        return None, i
+    if items[i].pow:
+        raise SyntaxError("Unexpected power of " + str(items[i].chars[0]))
+
+    operator = str(items[i].chars[0])
+    if operator in ["*", "/"] and i + 1 < len(items) and items[i + 1].type == MATH and \
+            str(items[i + 1].chars[0]) == operator:
+        if items[i + 1].pow:
+            raise SyntaxError("Unexpected power of " + operator)
+        return 2 * operator, i + 2
+
+    return operator, i + 1
+
+
+def is_parenthesis_item(items, i, symbol):
+    return i < len(items) and isinstance(items[i], Parenthesis) and items[i].symbol == symbol
+
+
+def is_implicit_product(items, i):
+    """ Checks if the operand group i is multiplied by the item before it without product sign """
+    return 0 < i < len(items) and isinstance(items[i], Group) and {items[i - 1].type, items[i].type} in \
+        IMPLICIT_PRODUCTS
+
+
+def compile_ast(node):
+    """ Compiles an ast expression node to a code object for eval """
+    return compile(ast.fix_missing_locations(ast.Expression(node)), "<formula>", "eval")
+
+
+def split_fractions(chars):
+    """ Divides are taken from the widest to the narrowest, each one takes every character left whose x interval
+    overlaps its own and splits them into above and below lists, a divide taken by a wider one is only a character.
+    Returns the (above, below) lists of the divides from the widest to the narrowest, and the characters left.
+    Works on the sorted x intervals of the divides in O(n log n) """
+    # Divides sorted by decreasing width, the last one first in case of tie
+    order = [i for i in range(len(chars)) if chars[i].prediction == '/']
+    order.sort(key=lambda i: (chars[i].width, i), reverse=True)
+
+    # Keep the divides not overlapping a wider one, their intervals are disjoint so sorted by both bounds
+    lefts, rights, kept = [], [], []
+    for i in order:
+        divide = chars[i]
+        position = bisect_left(lefts, divide.left)
+        neighbors = range(max(position - 1, 0), bisect_left(lefts, divide.right))
+        if any(rights[j] > divide.left and lefts[j] < divide.right for j in neighbors):
+            continue
+
+        lefts.insert(position, divide.left)
+        rights.insert(position, divide.right)
+        kept.insert(position, i)
+
+    # Order in which kept divides take characters
+    kept_set = set(kept)
+    ranked = [i for i in order if i in kept_set]
+    ranks = {i: rank for rank, i in enumerate(ranked)}
+
+    # Sparse table of the minimum rank over ranges of kept divides
+    min_ranks = [[ranks[i] for i in kept]]
+    length = 1
+    while 2 * length <= len(kept):
+        previous = min_ranks[-1]
+        min_ranks.append([min(previous[j], previous[j + length]) for j in range(len(previous) - length)])
+        length *= 2
+
+    # Each character is taken by the first divide overlapping it
+    fractions = [([], []) for _ in ranked]
+    chars_left = []
+    for i in range(len(chars)):
+        if i in kept_set:
+            continue
+
+        char = chars[i]
+        first, last = bisect_right(rights, char.left), bisect_left(lefts, char.right)
+        if first >= last:
+            chars_left.append(char)
+            continue
+
+        level = (last - first).bit_length() - 1
+        rank = min(min_ranks[level][first], min_ranks[level][last - (1 << level)])
+        above, below = fractions[rank]
+        if char.y <= chars[ranked[rank]].y:
+            above.append(char)
+        else:
+            below.append(char)
+
+    return fractions, chars_left
+
 
 def parenthesis_fix(raw_string):    # TODO REMOVE
     """ We are looking for patterns like *1*...*1 with minimal number of characters in "..." to replace by (...) """
@@ -272,40 +589,44 @@ def split_letter_group(group, variables):
     for char in group.chars:
         string += str(char)
 
-    # Split group
+    # Find every variable occurrence in one pass
+    occurrences = get_variable_matcher(variables).find_all(string)
+
+    # Split group, variables are matched in their order and each one from left to right
     groups = []
-    bounds = []
-    for var in variables:
-        var_bounds = finditer(var, string)
-        for var_bound in var_bounds:
-            if all([bound[0] >= var_bound.end() or bound[1] <= var_bound.start() for bound in bounds]):
+    covered = [False] * len(string)
+    for var_index in sorted(occurrences):
+        var_length = len(variables[var_index])
+        match_end = 0
+        for start in occurrences[var_index]:
+            # Matches of a variable don't overlap
+            if start < match_end:
+                continue
+            match_end = start + var_length
+
+            if not any(covered[start:match_end]):
                 # New group identified
-                bounds.append([var_bound.start(), var_bound.end()])
+                covered[start:match_end] = [True] * var_length
 
-                new_group = Group(group.chars[var_bound.start():var_bound.end()])
-                if var_bound.end() == len(group.chars):
+                new_group = Group(group.chars[start:match_end])
+                if match_end == len(group.chars):
                     new_group.pow = group.pow
                 groups.append(new_group)
 
     # Construct left groups
     begin = 0
-    grouping = all([0 < bound[0] or 0 >= bound[1] for bound in bounds])
+    grouping = not covered[0]
 
     for i in range(1, len(group.chars)):
         if grouping:
-            if not all([i < bound[0] or i >= bound[1] for bound in bounds]):
+            if covered[i]:
                 # Found a left group end
-                new_group = Group(group.chars[begin:i])
-
-                if i == len(group.chars):
-                    new_group.pow = group.pow
-
-                groups.append(new_group)
+                groups.append(Group(group.chars[begin:i]))
 
                 # Not grouping anymore
                 grouping = False
         else:
-            if all([i < bound[0] or i >= bound[1] for bound in bounds]):
+            if not covered[i]:
                 # Found a left group start
                 begin = i
                 grouping = True
@@ -322,43 +643,231 @@ def split_letter_group(group, variables):
     return groups
 
 
+class VariableMatcher:
+    def __init__(self, variables):
+        """ Aho-Corasick automaton finding every occurrence of the variable names in a string in one pass """
+        self.transitions = [{}]  # Node -> {letter: next node}
+        self.outputs = [[]]      # Node -> indices of the variables ending at this node
+        self.lengths = [len(var) for var in variables]
+
+        # Build the trie of the variable names
+        for var_index, var in enumerate(variables):
+            node = 0
+            for letter in var:
+                if letter not in self.transitions[node]:
+                    self.transitions.append({})
+                    self.outputs.append([])
+                    self.transitions[node][letter] = len(self.transitions) - 1
+                node = self.transitions[node][letter]
+            if len(var) > 0 and var_index not in self.outputs[node]:
+                self.outputs[node].append(var_index)
+
+        # Compute failure links breadth first, a node also outputs the variables of its failure node
+        self.failures = [0] * len(self.transitions)
+        queue = list(self.transitions[0].values())
+        for node in queue:
+            for letter, child in self.transitions[node].items():
+                failure = self.failures[node]
+                while failure and letter not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                if letter in self.transitions[failure]:
+                    self.failures[child] = self.transitions[failure][letter]
+                self.outputs[child] = self.outputs[child] + self.outputs[self.failures[child]]
+                queue.append(child)
+
+    def find_all(self, string):
+        """ Returns the start positions of the occurrences of each variable, as {variable index: sorted positions} """
+        occurrences = {}
+        node = 0
+        for end, letter in enumerate(string, 1):
+            while node and letter not in self.transitions[node]:
+                node = self.failures[node]
+            node = self.transitions[node].get(letter, 0)
+
+            for var_index in self.outputs[node]:
+                occurrences.setdefault(var_index, []).append(end - self.lengths[var_index])
+
+        return occurrences
+
+
+def get_variable_matcher(variables):
+    """ Returns the automaton of the variable names, rebuilt only when they change """
+    variables = tuple(variables)
+    if get_variable_matcher.variables != variables:
+        get_variable_matcher.matcher = VariableMatcher(variables)
+        get_variable_matcher.variables = variables
+
+    return get_variable_matcher.matcher
+
+
+get_variable_matcher.variables = None
+get_variable_matcher.matcher = None
+
+
 def classify_horizontal_lines(formula):
     """ This function checks if a '-' character is a minus or a divide """
-
-    for i in range(len(formula.chars)):
-        char = formula.chars[i]
-        if char.prediction == '-':
-            # Search the closest character over the horizontal line
-            min_distance, closest = float('inf'), None
-            for o_char in formula.chars:
-                if o_char == char:
-                    continue
-                if o_char.y < char.y and o_char.right >= char.left and o_char.left <= char.right:
-
-                    # Compute distance to the next '-' to search the closest
-                    if char.top - o_char.bottom < min_distance:
-                        min_distance = char.top - o_char.bottom
-                        closest = o_char
-
-            # If the closest character over is a digit or a letter, this character is a division
-            if closest and closest.get_type() in [DIGIT, LETTER]:
-                formula.chars[i].prediction = '/'
+    chars = formula.chars
+    lines = [i for i in range(len(chars)) if chars[i].prediction == '-']
+    if len(lines) == 0:
+        return formula
+
+    # Small formulas are faster to scan
+    if len(chars) <= LINEAR_SCAN_SIZE:
+        closests = [(chars[i], get_closest_above(chars, chars[i])) for i in lines]
+        closests = [(char, closest) for char, closest in closests if closest is not None]
+        return convert_divisions(formula, closests)
+
+    # Sweep the lines from top to bottom, indexing the x intervals of the characters above them
+    index = IntervalIndex(sorted(set(bound for char in chars for bound in [char.left, char.right])))
+    by_y = sorted(range(len(chars)), key=lambda i: chars[i].y)
+    indexed = 0
+
+    closests = []
+    for i in sorted(lines, key=lambda i: chars[i].y):
+        char = chars[i]
+        while indexed < len(by_y) and chars[by_y[indexed]].y < char.y:
+            o_char = chars[by_y[indexed]]
+            index.insert(o_char.left, o_char.right, (o_char.bottom, -by_y[indexed]))
+            indexed += 1
+
+        # Search the closest character over the horizontal line, the first one in case of tie
+        closest = index.query(char.left, char.right)
+        if closest is not None:
+            closests.append((char, chars[-closest[1]]))
+
+    return convert_divisions(formula, closests)
+
+
+def get_closest_above(chars, char):
+    """ Returns the closest character over the horizontal line char, the first one in case of tie """
+    min_distance, closest = float('inf'), None
+    for o_char in chars:
+        if o_char.y < char.y and o_char.right >= char.left and o_char.left <= char.right:
+            if char.top - o_char.bottom < min_distance:
+                min_distance = char.top - o_char.bottom
+                closest = o_char
+
+    return closest
+
+
+def convert_divisions(formula, closests):
+    """ Makes divisions of the (horizontal line, closest character over) pairs whose character is a digit or a
+    letter """
+    for char, closest in closests:
+        if closest.get_type() in [DIGIT, LETTER]:
+            char.prediction = '/'
 
     return formula
 
 
-def get_python_expression(formula, variables):
+class IntervalIndex:
+    def __init__(self, bounds):
+        """ Segment tree over the sorted bounds of closed x intervals, giving the maximal key of the intervals
+        intersecting an x range in O(log n) """
+        self.bounds = bounds
+        self.covering = [None] * (4 * len(bounds))  # Maximal key of the intervals covering a whole node range
+        self.touching = [None] * (4 * len(bounds))  # Maximal key of the intervals intersecting a node range
+
+    def insert(self, left, right, key):
+        first, last = bisect_left(self.bounds, left), bisect_left(self.bounds, right)
+        self.update(1, 0, len(self.bounds) - 1, first, last, key)
+
+    def update(self, node, low, high, first, last, key):
+        if last < low or high < first:
+            return
+
+        self.touching[node] = max_key(self.touching[node], key)
+        if first <= low and high <= last:
+            self.covering[node] = max_key(self.covering[node], key)
+            return
+
+        middle = (low + high) // 2
+        self.update(2 * node, low, middle, first, last, key)
+        self.update(2 * node + 1, middle + 1, high, first, last, key)
+
+    def query(self, left, right):
+        first, last = bisect_left(self.bounds, left), bisect_right(self.bounds, right) - 1
+        return self.search(1, 0, len(self.bounds) - 1, first, last)
+
+    def search(self, node, low, high, first, last):
+        if last < low or high < first:
+            return None
+        if first <= low and high <= last:
+            return self.touching[node]
+
+        middle = (low + high) // 2
+        return max_key(self.covering[node], max_key(self.search(2 * node, low, middle, first, last),
+                                                    self.search(2 * node + 1, middle + 1, high, first, last)))
+
+
+def max_key(key_a, key_b):
+    if key_a is None:
+        return key_b
+    if key_b is None:
+        return key_a
+    return max(key_a, key_b)
+
+
+def get_python_expression(formula, variables, version):
+    """ Returns the expression of the formula, version being the version of the variables, which the cached
+    expressions are kept for """
     formula = classify_horizontal_lines(formula)  # TODO maybe remove ?
-    exp = Expression(formula.chars, variables)
+    signature = get_parse_signature(Expression, formula, version)
+    exp = parse_cache.get(signature)
+    if exp is None:
+        exp = Expression(freeze_characters(formula.chars), variables)
+        parse_cache.put(signature, exp)
     return exp
 
 
-def get_python_equation(formula, variables):
+def get_python_equation(formula, variables, version):
     formula = classify_horizontal_lines(formula)  # TODO maybe remove ?
-    eq = Equation(formula.chars, variables)
+    signature = get_parse_signature(Equation, formula, version)
+    eq = parse_cache.get(signature)
+    if eq is None:
+        eq = Equation(freeze_characters(formula.chars), variables)
+        parse_cache.put(signature, eq)
     return eq
 
 
+def get_parse_signature(tree_class, formula, version):
+    """ Returns the parse cache key of a formula, taken after horizontal lines classification: the predictions and
+    bounds of its characters, and the version of the variables """
+    chars_signature = tuple((char.prediction, char.get_bounds()) for char in formula.chars)
+    return tree_class, chars_signature, version
+
+
+def freeze_characters(chars):
+    """ Parse trees are built from copies of the characters, so that the cached ones don't change with them """
+    return [FrozenCharacter(char) for char in chars]
+
+
+class FrozenCharacter(Box):
+    __slots__ = ("prediction",)
+
+    def __init__(self, char):
+        super().__init__(char)
+        self.prediction = char.prediction
+
+    def get_type(self):
+        if is_digit(self.prediction):
+            return DIGIT
+        elif is_letter(self.prediction):
+            return LETTER
+        elif is_math_symbol(self.prediction):
+            return MATH
+        elif is_parenthesis(self.prediction):
+            return PARENTHESIS
+        else:
+            raise AttributeError("Character " + self.prediction + " doesnt exists")
+
+    def __str__(self):
+        return self.prediction
+
+
+parse_cache = LRUCache(PARSE_CACHE_SIZE)
+
+
 def is_power(power_box, next_char):
     """ Checks if next_char is a power of char """
     return power_box.top >= next_char.bottom
@@ -1,22 +1,116 @@
-import tensorflow as tf
-from PIL import Image
 import numpy as np
-import numpy.linalg as lin
-import pyscreenshot as ImageGrab
+import hashlib
+import math
+import queue
+import threading
+import time
+import traceback
 
-from Page import Book
+import NumpyNetwork
+from CustomQueues import LRUCache
 
 # Capture parameters
 CAPTURE_SIZE = 32
 CAPTURE_MARGIN = 2
 
-# Model declaration
-default_model_path = "../Models/handwriting.model"
+# Pixel centers of the capture buffer, flattened row by row
+PIXEL_X, PIXEL_Y = [grid.ravel() for grid in np.meshgrid(np.arange(CAPTURE_SIZE, dtype=np.float32) + 0.5,
+                                                         np.arange(CAPTURE_SIZE, dtype=np.float32) + 0.5)]
+
+# Geometry quantization steps per character size used for prediction cache keys
+GEOMETRY_RESOLUTION = 2 * CAPTURE_SIZE
+
+# Number of candidate predictions kept for each character
+TOP_K = 3
+
+# Maximal number of predictions kept in the prediction cache
+PREDICTION_CACHE_SIZE = 512
+
+# Maximal number of resize matrices kept by the preprocessor, one per crop side length
+RESIZE_CACHE_SIZE = 128
+
+# Period between two checks of the recognition worker results (ms)
+POLL_PERIOD = 10
+
+# Time without new stroke on a character before recognizing it (ms)
+RECOGNITION_DELAY = 150
+
+# Number of times the worker tries to predict a character before giving up
+MAX_PREDICTION_ATTEMPTS = 2
+
+# Model declaration, by default the fastest engine is used: Keras if TensorFlow is installed and faster, else NumPy
+keras_model_path = "../Models/handwriting.model"
+numpy_model_path = "../Models/handwriting.npz"
+default_model_path = None
+
+# Batch size used to compare the engines speed, the size of the batches flushed while writing
+ENGINE_BENCHMARK_SIZE = 32
 
 
 # Module initialization
-def init(model_path=default_model_path):
-    image_predict.ocr_model = tf.keras.models.load_model(model_path)
+def init(root=None, model_path=default_model_path):
+    """ Without root, the model is loaded right away. With a root, the model is loaded by the recognition worker and
+    this function returns immediately, characters predicted before the model is ready wait in the worker queue """
+    # Flush the prediction queue on the root idle cycles
+    prediction_queue.root = root
+
+    # Cached predictions belong to the previous model
+    prediction_cache.clear()
+
+    if root is None:
+        batch_predict_candidates.ocr_model = load_model(model_path)
+    elif prediction_queue.worker is None:
+        # Load model and run predictions in the background
+        prediction_queue.worker = RecognitionWorker(model_path)
+        prediction_queue.worker.start()
+
+
+# Loads the CNN model, exported .npz models run on the NumPy engine, other ones on Keras
+# TensorFlow is only imported here as its import takes several seconds
+def load_model(model_path):
+    if model_path is None:
+        return load_fastest_model()
+    elif model_path.endswith(".npz"):
+        return NumpyNetwork.Network(model_path)
+
+    import tensorflow as tf
+    return tf.keras.models.load_model(model_path)
+
+
+def load_fastest_model():
+    """ Loads the model on the NumPy engine, and on Keras if TensorFlow is installed, and returns the one predicting a
+    batch of ENGINE_BENCHMARK_SIZE images the fastest. Keras is usually about 3 times faster on batches, NumPy loads
+    in milliseconds instead of seconds """
+    models = [("NumPy", NumpyNetwork.Network(numpy_model_path))]
+    try:
+        import tensorflow as tf
+        models.append(("Keras", tf.keras.models.load_model(keras_model_path)))
+    except ImportError:
+        pass
+    except Exception:
+        traceback.print_exc()
+
+    if len(models) == 1:
+        return models[0][1]
+
+    # Time a batch once the model graphs are built
+    images = np.zeros((ENGINE_BENCHMARK_SIZE, CAPTURE_SIZE, CAPTURE_SIZE, 1), dtype=np.float32)
+    timings = []
+    for _, model in models:
+        model.predict_on_batch(images)
+        start = time.perf_counter()
+        model.predict_on_batch(images)
+        timings.append(time.perf_counter() - start)
+
+    name, model = models[int(np.argmin(timings))]
+    print("Recognition runs on {} ({})".format(name, ", ".join(
+        "{} {:.0f} ms".format(engine, 1e3 * timing) for (engine, _), timing in zip(models, timings))))
+    return model
+
+
+# Runs a first prediction so that the model graph is built before the first character
+def warm_up():
+    batch_predict(np.zeros((1, CAPTURE_SIZE, CAPTURE_SIZE), dtype=np.float32))
 
 
 # Tests if char is a math symbol or not
@@ -33,7 +127,7 @@ def is_math_symbol(char):
         # Check for +
         ratios = [line.aspect_ratio for line in char.lines]
         ref_length = max([line.width for line in char.lines])
-        if min(ratios) < 0.33 and max(ratios) > 3.0 and lin.norm(char.lines[0].center - char.lines[1].center) / ref_length < 0.15:
+        if min(ratios) < 0.33 and max(ratios) > 3.0 and math.hypot(char.lines[0].x - char.lines[1].x, char.lines[0].y - char.lines[1].y) / ref_length < 0.15:
             return '+'
 
     return None
@@ -41,56 +135,407 @@ def is_math_symbol(char):
 
 # Predicts the given character
 def predict(char):
+    """ The prediction is given back to the character through char.set_prediction, either immediately for math
+    symbols or on the next prediction queue flush, as a list of (label, probability) candidates sorted by
+    decreasing probability """
     # Check if the character is a math symbol
     math_symbol = is_math_symbol(char)
 
     if math_symbol:
-        return math_symbol
+        prediction_queue.discard(char)
+        char.set_prediction([(math_symbol, 1.0)])
+        return
+
+    # Check if the same glyph was already predicted
+    key = geometry_key(char)
+    candidates = prediction_cache.get(key)
+
+    if candidates is not None:
+        prediction_queue.discard(char)
+        char.set_prediction(candidates)
+        return
+
+    # Draw character offscreen and queue it for the next batched prediction
+    prediction_queue.put(char, rasterize(char), key)
+
+
+def schedule_prediction(char, delay=RECOGNITION_DELAY):
+    """ Predicts the character once no stroke was added to it for delay ms, scheduling it again restarts the timer """
+    prediction_queue.schedule(char, delay)
+
+
+def cancel_prediction(char):
+    """ Cancels the scheduled, pending or running prediction of the character """
+    prediction_queue.discard(char)
+
+
+# Hashes the character stroke geometry
+def geometry_key(char):
+    """ Returns a key identifying the character glyph: strokes are normalized relatively to the character box,
+    quantized and hashed independently of their order """
+    x1, y1, x2, y2 = char.get_bounds()
+    scale_factor = GEOMETRY_RESOLUTION / max(x2 - x1, y2 - y1)
+
+    line_digests = []
+    for line in char.lines:
+        points = np.rint((np.asarray(line.points) - (x1, y1)) * scale_factor).astype(np.int16)
+        line_hash = hashlib.blake2b(points.tobytes(), digest_size=16)
+        line_hash.update(str(round(line.stroke_width * scale_factor)).encode())
+        line_digests.append(line_hash.digest())
+
+    return hashlib.blake2b(b"".join(sorted(line_digests)), digest_size=16).digest()
+
+
+# Least recently used cache of the CNN predictions, indexed by glyph geometry keys
+prediction_cache = LRUCache(PREDICTION_CACHE_SIZE, count_hits=True)
+
+
+# Returns prediction cache statistics
+def cache_info():
+    return prediction_cache.info()
+
+
+class RecognitionWorker(threading.Thread):
+    """ Runs the CNN predictions in a background thread so that the Tk mainloop never waits for them """
+
+    def __init__(self, model_path=default_model_path):
+        super().__init__(daemon=True)
+        self.model_path = model_path
+        self.requests = queue.Queue()   # (request id, images)
+        self.responses = queue.Queue()  # (request id, candidates of each image)
+
+        # Set if the model couldn't be loaded
+        self.error = None
+
+    def run(self):
+        # Load model, requests sent in the meantime wait in the queue
+        try:
+            batch_predict_candidates.ocr_model = load_model(self.model_path)
+            warm_up()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = "Couldn't load model " + str(self.model_path) + ": " + repr(e)
+            print(self.error)
+
+        while True:
+            request_id, images = self.requests.get()
+
+            # Without model, every request fails
+            if self.error is not None:
+                self.responses.put((request_id, None))
+                continue
+
+            try:
+                candidates = batch_predict_candidates(images)
+            except Exception:
+                # Characters of a failed request are sent again or given up by the prediction queue
+                traceback.print_exc()
+                candidates = None
+            self.responses.put((request_id, candidates))
+
+
+class PredictionQueue:
+    """ Gathers the characters waiting for a CNN prediction and predicts all of them in a single batch, once per
+    Tk idle cycle. Batches are sent to the recognition worker and results are given back through root.after """
+
+    def __init__(self):
+        # Root used to schedule flushes and worker running predictions, if None the queue is flushed on each put
+        self.root = None
+        self.worker = None
+
+        # Recognition timers of the characters being written
+        self.timers = {}
+
+        # Pending geometry keys and images, a character only keeps its latest ones
+        self.pending = {}
+        self.flush_scheduled = False
+
+        # Requests sent to the worker, and latest request of each character
+        self.request_count = 0
+        self.in_flight = {}
+        self.latest_request = {}
+        self.polling = False
+
+    def put(self, char, margin_img, key):
+        self.pending[char] = (key, margin_img)
+
+        if self.root is None:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.root.after_idle(self.flush)
+
+    def schedule(self, char, delay):
+        self.discard(char)
+
+        # Without root, predict right now
+        if self.root is None:
+            predict(char)
+            return
 
-    # Grab image
-    x_offset, y_offset = Book.canvas.winfo_rootx(), Book.canvas.winfo_rooty()
+        self.timers[char] = self.root.after(delay, lambda: self.end_timer(char))
+
+    def end_timer(self, char):
+        del self.timers[char]
+        predict(char)
+
+    def discard(self, char):
+        # Cancel the recognition timer
+        timer = self.timers.pop(char, None)
+        if timer is not None:
+            self.root.after_cancel(timer)
+
+        # Forget the pending image and ignore any prediction still computed by the worker
+        self.pending.pop(char, None)
+        self.latest_request.pop(char, None)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if len(self.pending) == 0:
+            return
+
+        # Empty the queue before giving predictions back, callbacks may queue new characters
+        chars = list(self.pending.keys())
+        keys = [key for key, _ in self.pending.values()]
+        images = np.stack([margin_img for _, margin_img in self.pending.values()])
+        self.pending.clear()
+
+        # Without worker, predict every pending character right now in one forward pass
+        if self.worker is None:
+            for char, key, candidates in zip(chars, keys, batch_predict_candidates(images)):
+                prediction_cache.put(key, candidates)
+                char.set_prediction(candidates)
+            return
+
+        # A worker without model fails every request
+        if self.worker.error is not None:
+            for char in chars:
+                self.latest_request.pop(char, None)
+                char.set_prediction_failed()
+            return
+
+        self.send(list(zip(chars, keys)), images)
+
+    def send(self, requests, images, attempts=1):
+        """ Sends the images of the (character, geometry key) requests to the worker """
+        self.request_count += 1
+        self.in_flight[self.request_count] = (requests, images, attempts)
+        for char, _ in requests:
+            self.latest_request[char] = self.request_count
+        self.worker.requests.put((self.request_count, images))
+
+        # Wait for the results
+        if not self.polling:
+            self.polling = True
+            self.root.after(POLL_PERIOD, self.poll)
+
+    def fail(self, request_id, requests, images, attempts):
+        """ Sends a failed request again, or gives its characters up after MAX_PREDICTION_ATTEMPTS """
+        # Characters predicted again since the request don't wait for it anymore
+        indices = [i for i, (char, _) in enumerate(requests) if self.latest_request.get(char) == request_id]
+        if len(indices) == 0:
+            return
+
+        if attempts < MAX_PREDICTION_ATTEMPTS and self.worker.error is None:
+            print("Recognition of {} characters failed, retrying".format(len(indices)))
+            self.send([requests[i] for i in indices], images[indices], attempts + 1)
+            return
+
+        print("Recognition of {} characters failed, correct them in their formula entry".format(len(indices)))
+        for i in indices:
+            char = requests[i][0]
+            del self.latest_request[char]
+            char.set_prediction_failed()
+
+    def poll(self):
+        # Give back every available result
+        while True:
+            try:
+                request_id, candidates_list = self.worker.responses.get_nowait()
+            except queue.Empty:
+                break
+
+            requests, images, attempts = self.in_flight.pop(request_id)
+            if candidates_list is None:
+                self.fail(request_id, requests, images, attempts)
+                continue
+
+            for (char, key), candidates in zip(requests, candidates_list):
+                prediction_cache.put(key, candidates)
+
+                # Ignore outdated predictions
+                if self.latest_request.get(char) == request_id:
+                    del self.latest_request[char]
+                    char.set_prediction(candidates)
+
+        # Keep polling while requests are being computed
+        if len(self.in_flight) > 0:
+            self.root.after(POLL_PERIOD, self.poll)
+        else:
+            self.polling = False
+
+
+prediction_queue = PredictionQueue()
+
+
+# Draws the character strokes in a CAPTURE_SIZE x CAPTURE_SIZE buffer
+def rasterize(char):
+    """ Returns the squared and margined image image_predict would build from a screen capture of the character,
+    computed from the recorded stroke points only """
+    # Get scale factor and offset mapping canvas coordinates to buffer coordinates
     x1, y1, x2, y2 = char.get_bounds()
-    img = ImageGrab.grab(bbox=(x_offset + x1, y_offset + y1, x_offset + x2, y_offset + y2))
+    scale_factor = (CAPTURE_SIZE - 2 * CAPTURE_MARGIN) / max(x2 - x1, y2 - y1)
+    offset = np.array([0.5 * CAPTURE_SIZE - scale_factor * 0.5 * (x1 + x2),
+                       0.5 * CAPTURE_SIZE - scale_factor * 0.5 * (y1 + y2)], dtype=np.float32)
+
+    # Gather every stroke segment with its radius
+    starts, ends, radii = [], [], []
+    for line in char.lines:
+        points = np.asarray(line.points, dtype=np.float32) * np.float32(scale_factor) + offset
+        if len(points) == 1:
+            # Single point stroke: draw a dot
+            points = np.concatenate([points, points])
+        starts.append(points[:-1])
+        ends.append(points[1:])
+        radii.append(np.full(len(points) - 1, 0.5 * line.stroke_width * scale_factor, dtype=np.float32))
+
+    starts, ends, radii = np.concatenate(starts), np.concatenate(ends), np.concatenate(radii)
+
+    # Distance from every pixel center to every segment
+    dx, dy = (ends - starts).T
+    start_x, start_y = starts[:, 0:1], starts[:, 1:2]
+    rel_x, rel_y = PIXEL_X - start_x, PIXEL_Y - start_y
+    t = (rel_x * dx[:, None] + rel_y * dy[:, None]) / np.maximum(dx * dx + dy * dy, 1e-12)[:, None]
+    np.clip(t, 0.0, 1.0, out=t)
+    rel_x -= t * dx[:, None]
+    rel_y -= t * dy[:, None]
+    dist = np.sqrt(rel_x * rel_x + rel_y * rel_y)
+
+    # Antialiased coverage, keeping the most covering segment for each pixel
+    coverage = np.clip(radii[:, None] + 0.5 - dist, 0.0, 1.0).max(axis=0)
+
+    # Map values to 0.0 -> 1.0
+    margin_img = coverage.reshape(CAPTURE_SIZE, CAPTURE_SIZE)
+    max_value = margin_img.max()
+    if max_value > 0:
+        margin_img /= max_value
 
-    # Predict character
-    return image_predict(img)
+    return margin_img
 
 
 # Use CNN to predict the character from image
-# image_predict function has one static attribute: ocr_model
 def image_predict(img):
-    # Check not to raise error
-    if not hasattr(image_predict, "ocr_model"):
-        image_predict.ocr_model = tf.keras.models.load_model(default_model_path)
+    return batch_predict(preprocessor.process([img]))[0]
 
-    # Get size and scale factor
-    size_x, size_y = img.size
-    scale_factor = (CAPTURE_SIZE - 2 * CAPTURE_MARGIN) / np.max(img.size)
 
-    # Convert raw image to a squared one
-    img = img.convert('L').resize((int(scale_factor * size_x), int(scale_factor * size_y)), Image.ANTIALIAS)
+# Use CNN to predict the characters from a list of images
+def images_predict(imgs):
+    return batch_predict(preprocessor.process(imgs))
 
-    # Map values to 0.0 -> 1.0
-    img = np.array(img)
-    img = img - np.min(img)
-    img = img / np.max(img)
 
-    # Square the image and add margin
-    margin_img = np.zeros((CAPTURE_SIZE, CAPTURE_SIZE))
-    offset_x, rest_x = (CAPTURE_SIZE - img.shape[0]) // 2, (CAPTURE_SIZE - img.shape[0]) % 2
-    offset_y, rest_y = (CAPTURE_SIZE - img.shape[1]) // 2, (CAPTURE_SIZE - img.shape[1]) % 2
-    margin_img[offset_x:CAPTURE_SIZE - offset_x - rest_x, offset_y:CAPTURE_SIZE - offset_y - rest_y] = img
+class Preprocessor:
+    """ Converts raw character crops (PIL images or arrays, gray or RGB) to squared and margined images. Crops are
+    resized with area weights so that their largest side fits in the capture size, mapped to 0.0 -> 1.0 and centered
+    in a preallocated output batch """
+
+    # ITU-R 601-2 luma weights, same as PIL 'L' conversion
+    LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+    def __init__(self, capacity=32):
+        self.buffer = np.zeros((capacity, CAPTURE_SIZE, CAPTURE_SIZE), dtype=np.float32)
+        self.resize_matrices = LRUCache(RESIZE_CACHE_SIZE)
+
+    def process(self, crops):
+        """ Returns a (N, CAPTURE_SIZE, CAPTURE_SIZE) float32 view on the output buffer, only valid until the next call """
+        # Grow output buffer if needed
+        if len(crops) > len(self.buffer):
+            self.buffer = np.zeros((2 * len(crops), CAPTURE_SIZE, CAPTURE_SIZE), dtype=np.float32)
+
+        batch = self.buffer[:len(crops)]
+        batch.fill(0.0)
+
+        # Convert to grayscale and gather the crops of the same size
+        crops_by_size = {}
+        for index, crop in enumerate(crops):
+            crop = np.asarray(crop, dtype=np.float32)
+            if crop.ndim == 3:
+                crop = crop[:, :, :3] @ self.LUMA
+            crops_by_size.setdefault(crop.shape, []).append((index, crop))
+
+        for (size_y, size_x), sized_crops in crops_by_size.items():
+            indices = [index for index, _ in sized_crops]
+            stacked = np.stack([crop for _, crop in sized_crops])
+
+            # Resize the crops so that their largest side fits in the capture size without margin, in one matmul
+            scale_factor = (CAPTURE_SIZE - 2 * CAPTURE_MARGIN) / max(size_x, size_y)
+            new_size_y, new_size_x = max(int(scale_factor * size_y), 1), max(int(scale_factor * size_x), 1)
+            imgs = self.resize_matrix(new_size_y, size_y) @ stacked @ self.resize_matrix(new_size_x, size_x).T
+
+            # Square the images and add margin, background is set to 0.0
+            offset_y, offset_x = (CAPTURE_SIZE - new_size_y) // 2, (CAPTURE_SIZE - new_size_x) // 2
+            batch[indices, offset_y:offset_y + new_size_y, offset_x:offset_x + new_size_x] = \
+                imgs - imgs.min(axis=(1, 2), keepdims=True)
+
+        # Map values to 0.0 -> 1.0
+        max_values = batch.max(axis=(1, 2))
+        max_values[max_values == 0.0] = 1.0
+        batch /= max_values[:, None, None]
+
+        return batch
+
+    def resize_matrix(self, new_size, size):
+        """ Returns the (new_size, size) matrix averaging input pixels over each output pixel, weighted by overlap """
+        key = (new_size, size)
+        matrix = self.resize_matrices.get(key)
+        if matrix is None:
+            # Output pixel bounds in input coordinates
+            step = size / new_size
+            starts = np.arange(new_size)[:, None] * step
+            ends = starts + step
+
+            # Overlap of each output pixel with each input pixel
+            pixels = np.arange(size)[None, :]
+            overlap = np.clip(np.minimum(ends, pixels + 1) - np.maximum(starts, pixels), 0.0, None)
+            matrix = (overlap / step).astype(np.float32)
+            self.resize_matrices.put(key, matrix)
 
-    # Predict character
-    prediction = image_predict.ocr_model.predict(margin_img[None, :, :])
+        return matrix
 
-    prediction = np.argmax(prediction)
 
-    if prediction < 10:
+preprocessor = Preprocessor()
+
+
+# Use CNN to predict the character from a squared and margined image
+def array_predict(margin_img):
+    return batch_predict(margin_img[None, :, :])[0]
+
+
+# Use CNN to predict a batch of squared and margined images
+def batch_predict(margin_imgs):
+    return [candidates[0][0] for candidates in batch_predict_candidates(margin_imgs, 1)]
+
+
+# Use CNN to get the k most probable characters of a batch of squared and margined images
+# batch_predict_candidates function has one static attribute: ocr_model
+def batch_predict_candidates(margin_imgs, k=TOP_K):
+    """ Returns a list of (label, probability) candidates for each image, sorted by decreasing probability """
+    # Check not to raise error
+    if not hasattr(batch_predict_candidates, "ocr_model"):
+        batch_predict_candidates.ocr_model = load_model(default_model_path)
+
+    # Predict characters in one forward pass
+    probabilities = np.asarray(batch_predict_candidates.ocr_model.predict_on_batch(margin_imgs[:, :, :, None]))
+    labels = np.argsort(probabilities, axis=1)[:, :-k - 1:-1]
+
+    return [[(label_to_char(label), float(image_probabilities[label])) for label in image_labels]
+            for image_labels, image_probabilities in zip(labels, probabilities)]
+
+
+# Converts a CNN output index to its character
+def label_to_char(label):
+    if label < 10:
         # The prediction is a digit
-        return chr(ord('0') + prediction)
+        return chr(ord('0') + label)
     else:
         # The prediction is a letter
-        return chr(ord('A') + prediction - 10)
-
-
+        return chr(ord('A') + label - 10)
@@ -17,6 +17,8 @@ variables_eval = {}
 
 variable_callbacks = {"any": []}  # Contains functions to be called when a variable is updated
 
+version = 0  # Incremented each time the names of the declared variables or functions change
+
 
 # Callback execution function
 def execute_callbacks(var):
@@ -35,8 +37,36 @@ def get_variable_names():
     return names
 
 
+def get_state():
+    """ Returns a copy of the declared variables and functions """
+    callbacks = {var: list(var_callbacks) for var, var_callbacks in variable_callbacks.items() if var != "any"}
+    return dict(variables_sym), dict(variables_eval), callbacks
+
+
+def set_state(state):
+    """ Restores declared variables and functions returned by get_state """
+    global version
+    sym_state, eval_state, callbacks_state = state
+    if eval_state.keys() != variables_eval.keys():
+        version += 1
+
+    variables_sym.clear()
+    variables_sym.update(sym_state)
+    variables_eval.clear()
+    variables_eval.update(eval_state)
+
+    # Keep the callbacks of the windows
+    any_callbacks = variable_callbacks["any"]
+    variable_callbacks.clear()
+    variable_callbacks.update({var: list(var_callbacks) for var, var_callbacks in callbacks_state.items()})
+    variable_callbacks["any"] = any_callbacks
+
+    # Call variable callbacks
+    execute_callbacks("any")
+
+
 def evaluate(equation):
-    print(equation)
+    global version
 
     # Initialize output
     output = None
@@ -50,8 +80,8 @@ def evaluate(equation):
     # We enter this mode if :
     #   - No undeclared variables on the left side
     #   - No characters on the right side
-    if len(left_undeclared_vars) == 0 and len(equation.right) == 0:
-        output = str(eval(str(equation.left), globals_eval, variables_eval))
+    if len(left_undeclared_vars) == 0 and len(equation.right.base) == 0:
+        output = str(eval(equation.left.compile(), globals_eval, variables_eval))
         print(output)
 
     # VARIABLE DECLARATION MODE
@@ -65,14 +95,14 @@ def evaluate(equation):
         variables_sym[new_var] = sp.Symbol(new_var)
 
         # Create equation object
-        equation = "_solve = " + str(equation.left) + '-' + str(equation.right)
-        exec(equation, globals_sym, variables_sym)
+        variables_sym["_solve"] = eval(equation.compile_difference(), globals_sym, variables_sym)
 
         # Compute solution
         output = sp.solve(variables_sym["_solve"], variables_sym[new_var])
 
         # Assign value
         variables_eval[new_var] = output[0]
+        version += 1
 
         if new_var in variable_callbacks.keys():
             # Execute constant callbacks
@@ -101,8 +131,7 @@ def evaluate(equation):
         var = str(equation.left.base[0])
 
         # Create equation object
-        equation = "_solve = " + str(equation.left) + '-' + str(equation.right)
-        exec(equation, globals_sym, variables_sym)
+        variables_sym["_solve"] = eval(equation.compile_difference(), globals_sym, variables_sym)
 
         # Compute solution
         output = sp.solve(variables_sym["_solve"], variables_sym[var])
@@ -138,7 +167,7 @@ def evaluate(equation):
         variables_sym[variable] = sp.Symbol(variable)
 
         # Declare symbolic function
-        exec(function + "_sym" + '=' + str(equation.right), globals_sym, variables_sym)
+        variables_sym[function + "_sym"] = eval(equation.right.compile(), globals_sym, variables_sym)
 
         # Simplify function and make it a sympy instance
         variables_sym[function + "_sym"] = sp.simplify(variables_sym[function + "_sym"])
@@ -155,6 +184,8 @@ def evaluate(equation):
             return f_x.evalf()
 
         # Save python function in eval variables
+        if function not in variables_eval:
+            version += 1
         variables_eval[function] = f_eval
 
         if function in variable_callbacks.keys():
@@ -0,0 +1,309 @@
+import argparse
+import json
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Model export
+def export(model_path, npz_path):
+    """ Reads a Keras HDF5 model (Sequential or functional) and saves its graph and weights in a compact .npz file.
+    Batch normalizations are folded into a per channel scale and shift at export time, and into the previous
+    convolution when possible """
+    import h5py
+
+    with h5py.File(model_path, "r") as f:
+        config = json.loads(f.attrs["model_config"])
+        weights_group = f["model_weights"] if "model_weights" in f else f
+
+        # Sequential models may store their layers directly in the config
+        layer_configs = config["config"]["layers"] if isinstance(config["config"], dict) else config["config"]
+        is_sequential = config["class_name"] == "Sequential"
+
+        layers, arrays = [], {}
+        previous = None
+
+        # Sequential models have an implicit input layer
+        if is_sequential and layer_configs[0]["class_name"] != "InputLayer":
+            previous = "input"
+            layers.append({"name": previous, "type": "InputLayer", "inputs": [],
+                           "shape": layer_configs[0]["config"]["batch_input_shape"][1:]})
+
+        for layer_config in layer_configs:
+            class_name, layer_params = layer_config["class_name"], layer_config["config"]
+            name = layer_params["name"]
+
+            # Get layer inputs
+            if is_sequential:
+                inputs = [previous] if previous else []
+            else:
+                inputs = [node[0] for node in layer_config["inbound_nodes"][0]] if layer_config["inbound_nodes"] else []
+
+            layer = {"name": name, "type": class_name, "inputs": inputs}
+            weights = read_weights(weights_group, name)
+
+            if class_name == "InputLayer":
+                layer["shape"] = layer_params["batch_input_shape"][1:]
+
+            elif class_name == "Conv2D":
+                layer["strides"] = layer_params["strides"]
+                layer["padding"] = layer_params["padding"]
+                layer["activation"] = layer_params["activation"]
+                arrays[name + ":kernel"] = weights["kernel"]
+                if layer_params["use_bias"]:
+                    arrays[name + ":bias"] = weights["bias"]
+
+            elif class_name == "BatchNormalization":
+                # Fold normalization in an affine transform
+                scale = 1.0 / np.sqrt(weights["moving_variance"] + layer_params["epsilon"])
+                if layer_params["scale"]:
+                    scale = scale * weights["gamma"]
+                shift = -weights["moving_mean"] * scale
+                if layer_params["center"]:
+                    shift = shift + weights["beta"]
+                arrays[name + ":scale"], arrays[name + ":shift"] = scale, shift
+
+            elif class_name == "Dense":
+                layer["activation"] = layer_params["activation"]
+                arrays[name + ":kernel"] = weights["kernel"]
+                if layer_params["use_bias"]:
+                    arrays[name + ":bias"] = weights["bias"]
+
+            elif class_name == "Activation":
+                layer["activation"] = layer_params["activation"]
+
+            elif class_name in ["AveragePooling2D", "MaxPooling2D"]:
+                assert layer_params["padding"] == "valid", "Only valid padding is supported for pooling layers"
+                layer["pool_size"] = layer_params["pool_size"]
+                layer["strides"] = layer_params["strides"] or layer_params["pool_size"]
+
+            elif class_name not in ["Add", "Flatten", "Dropout"]:
+                raise ValueError("Layer type " + class_name + " isn't supported")
+
+            layers.append(layer)
+            previous = name
+
+        # Get output layer
+        output = previous if is_sequential else config["config"]["output_layers"][0][0]
+
+    layers = fold_batch_normalizations(layers, arrays)
+
+    np.savez_compressed(npz_path, graph=json.dumps({"layers": layers, "output": output}),
+                        **{key: array.astype(np.float32) for key, array in arrays.items()})
+
+
+def read_weights(weights_group, layer_name):
+    """ Returns the layer weights as a dictionary of short names (kernel, bias, gamma...) and arrays """
+    if layer_name not in weights_group:
+        return {}
+
+    group = weights_group[layer_name]
+    weights = {}
+    for weight_name in group.attrs["weight_names"]:
+        weight_name = weight_name.decode() if isinstance(weight_name, bytes) else weight_name
+        weights[weight_name.split('/')[-1].split(':')[0]] = group[weight_name][()]
+
+    return weights
+
+
+def fold_batch_normalizations(layers, arrays):
+    """ Merges each batch normalization into the convolution feeding it, when this convolution has no activation and
+    no other output. Returns the new layer list """
+    consumers = {}
+    for layer in layers:
+        for name in layer["inputs"]:
+            consumers[name] = consumers.get(name, 0) + 1
+
+    layer_by_name = {layer["name"]: layer for layer in layers}
+    renamed, folded_layers = {}, []
+
+    for layer in layers:
+        layer["inputs"] = [renamed.get(name, name) for name in layer["inputs"]]
+
+        if layer["type"] == "BatchNormalization":
+            conv = layer_by_name[layer["inputs"][0]]
+            if conv["type"] == "Conv2D" and conv["activation"] == "linear" and consumers[conv["name"]] == 1:
+                # Scale convolution kernel and bias
+                scale, shift = arrays.pop(layer["name"] + ":scale"), arrays.pop(layer["name"] + ":shift")
+                arrays[conv["name"] + ":kernel"] = arrays[conv["name"] + ":kernel"] * scale
+                arrays[conv["name"] + ":bias"] = arrays.get(conv["name"] + ":bias", 0.0) * scale + shift
+
+                # Following layers now read the convolution output
+                renamed[layer["name"]] = conv["name"]
+                continue
+
+        folded_layers.append(layer)
+
+    return folded_layers
+
+
+class Network:
+    """ Forward pass of an exported model, only using NumPy. The predict_on_batch method has the same behaviour as the
+    Keras one so that a Network can be used in place of a Keras model """
+
+    def __init__(self, npz_path):
+        with np.load(npz_path) as data:
+            graph = json.loads(str(data["graph"]))
+            self.weights = {key: data[key] for key in data.files if key != "graph"}
+
+        self.layers = graph["layers"]
+        self.output = graph["output"]
+
+    def predict_on_batch(self, images):
+        """ Returns the model output """
+        outputs = {}
+
+        for layer in self.layers:
+            if layer["type"] == "InputLayer":
+                # Add channel axis if needed
+                x = np.asarray(images, dtype=np.float32)
+                outputs[layer["name"]] = x.reshape((x.shape[0],) + tuple(layer["shape"]))
+            else:
+                inputs = [outputs[name] for name in layer["inputs"]]
+                outputs[layer["name"]] = LAYER_FUNCTIONS[layer["type"]](self, layer, inputs)
+
+        return outputs[self.output]
+
+    def predict(self, images):
+        return self.predict_on_batch(images)
+
+    # Layers
+    def conv2d(self, layer, inputs):
+        x = conv2d(inputs[0], self.weights[layer["name"] + ":kernel"], layer["strides"], layer["padding"])
+        if layer["name"] + ":bias" in self.weights:
+            x += self.weights[layer["name"] + ":bias"]
+        return activation(x, layer["activation"])
+
+    def batch_normalization(self, layer, inputs):
+        x = inputs[0] * self.weights[layer["name"] + ":scale"]
+        x += self.weights[layer["name"] + ":shift"]
+        return x
+
+    def dense(self, layer, inputs):
+        x = inputs[0] @ self.weights[layer["name"] + ":kernel"]
+        if layer["name"] + ":bias" in self.weights:
+            x += self.weights[layer["name"] + ":bias"]
+        return activation(x, layer["activation"])
+
+    def activation(self, layer, inputs):
+        return activation(inputs[0], layer["activation"])
+
+    def pooling(self, layer, inputs):
+        windows = sliding_window_view(inputs[0], layer["pool_size"], axis=(1, 2))
+        windows = windows[:, ::layer["strides"][0], ::layer["strides"][1]]
+        if layer["type"] == "AveragePooling2D":
+            return windows.mean(axis=(4, 5))
+        return windows.max(axis=(4, 5))
+
+    def add(self, layer, inputs):
+        return sum(inputs[1:], inputs[0])
+
+    def flatten(self, layer, inputs):
+        return inputs[0].reshape(inputs[0].shape[0], -1)
+
+    def identity(self, layer, inputs):
+        return inputs[0]
+
+
+LAYER_FUNCTIONS = {"Conv2D": Network.conv2d, "BatchNormalization": Network.batch_normalization,
+                   "Dense": Network.dense, "Activation": Network.activation,
+                   "AveragePooling2D": Network.pooling, "MaxPooling2D": Network.pooling,
+                   "Add": Network.add, "Flatten": Network.flatten, "Dropout": Network.identity}
+
+
+def conv2d(x, kernel, strides, padding):
+    """ Batched NHWC convolution computed as a single matrix product (im2col) """
+    n, h, w, c = x.shape
+    kh, kw, _, filters = kernel.shape
+    sh, sw = strides
+
+    # Pad input the same way Keras does
+    if padding == "same":
+        out_h, out_w = -(-h // sh), -(-w // sw)
+        pad_h, pad_w = max((out_h - 1) * sh + kh - h, 0), max((out_w - 1) * sw + kw - w, 0)
+        if pad_h > 0 or pad_w > 0:
+            x = np.pad(x, ((0, 0), (pad_h // 2, pad_h - pad_h // 2), (pad_w // 2, pad_w - pad_w // 2), (0, 0)))
+    else:
+        out_h, out_w = (h - kh) // sh + 1, (w - kw) // sw + 1
+
+    # Pointwise convolutions don't need any patch extraction
+    if kh == 1 and kw == 1:
+        cols = x[:, ::sh, ::sw, :][:, :out_h, :out_w, :].reshape(-1, c)
+        return (cols @ kernel[0, 0]).reshape(n, out_h, out_w, filters)
+
+    # Extract every patch as a row: (n * out_h * out_w, kh * kw * c), by stacking the input shifted for each tap
+    cols = np.concatenate([x[:, i:i + sh * (out_h - 1) + 1:sh, j:j + sw * (out_w - 1) + 1:sw, :]
+                           for i in range(kh) for j in range(kw)], axis=3).reshape(-1, kh * kw * c)
+
+    return (cols @ kernel.reshape(-1, filters)).reshape(n, out_h, out_w, filters)
+
+
+def activation(x, name):
+    if name == "relu":
+        return np.maximum(x, 0.0, out=x)
+    elif name == "softmax":
+        x = np.exp(x - x.max(axis=-1, keepdims=True))
+        return x / x.sum(axis=-1, keepdims=True)
+    elif name == "linear":
+        return x
+    else:
+        raise ValueError("Activation " + name + " isn't supported")
+
+
+# Benchmark against Keras
+def benchmark(model_path, npz_path, batch_size=32, runs=20):
+    """ Compares the NumPy engine with Keras on random images: load time, argmax agreement, output difference and
+    latency """
+    import ImageRecognition as ir
+
+    # Compare load times, Keras one includes the TensorFlow import
+    start = time.perf_counter()
+    keras_model = ir.load_model(model_path)
+    keras_load = time.perf_counter() - start
+    start = time.perf_counter()
+    numpy_model = Network(npz_path)
+    numpy_load = time.perf_counter() - start
+    print("Load time: Keras {:.2f} s, NumPy {:.3f} s".format(keras_load, numpy_load))
+
+    images = np.random.default_rng(0).random((batch_size, ir.CAPTURE_SIZE, ir.CAPTURE_SIZE), dtype=np.float32)
+
+    # Compare outputs
+    keras_output = np.asarray(keras_model.predict_on_batch(images[:, :, :, None]))
+    numpy_output = numpy_model.predict_on_batch(images)
+    agreement = np.mean(np.argmax(keras_output, axis=1) == np.argmax(numpy_output, axis=1))
+    print("Argmax agreement: {:.1%}, max output difference: {:.2e}".format(
+        agreement, np.max(np.abs(keras_output - numpy_output))))
+
+    # Compare latencies for a single image and for a batch
+    for size in [1, batch_size]:
+        for engine, model in [("Keras", keras_model), ("NumPy", numpy_model)]:
+            batch = images[:size, :, :, None]
+            model.predict_on_batch(batch)
+            start = time.perf_counter()
+            for _ in range(runs):
+                model.predict_on_batch(batch)
+            elapsed = (time.perf_counter() - start) / runs
+            print("{}: batch {}: {:.2f} ms per batch, {:.3f} ms per image".format(
+                engine, size, 1e3 * elapsed, 1e3 * elapsed / size))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NumPy inference engine for the handwriting CNN")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export a Keras HDF5 model to a .npz file")
+    export_parser.add_argument("model_path")
+    export_parser.add_argument("npz_path")
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Compare the NumPy engine with Keras")
+    benchmark_parser.add_argument("model_path")
+    benchmark_parser.add_argument("npz_path")
+    benchmark_parser.add_argument("--batch-size", type=int, default=32)
+    benchmark_parser.add_argument("--runs", type=int, default=20)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.model_path, args.npz_path)
+    else:
+        benchmark(args.model_path, args.npz_path, args.batch_size, args.runs)
@@ -1,11 +1,11 @@
 import tkinter as tk
 
 from Brush import Brush
-from CustomQueues import Deque
+from Commands import AddStroke, DeleteStroke, Evaluate
+from CustomQueues import CommandGroup
 import Interpreter as ip
 from Page import Book
 import ImageRecognition as ir
-import FormulaRepresentation as fr
 
 
 class App:
@@ -17,6 +17,9 @@ class App:
         self.window.attributes('-zoomed', True)
         self.window.title("OGMA")
 
+        # Initialize OCR module, the model is loaded in the background
+        ir.init(self.window)
+
         # Buttons frame
         buttons_frame = tk.Frame(self.window)
         buttons_frame.pack(side=tk.TOP)
@@ -30,15 +33,19 @@ class App:
         new_page_button = tk.Button(buttons_frame, text="New page")
         new_page_button.pack(side=tk.LEFT)
 
-        # Create book of pages
+        # Create book of pages, page canvases are bound each time they are created
         self.book = Book(self.window)
-        self.new_page()
+        self.book.canvas_callback = self.bind_canvas
+        self.book.new_page()
         # Assign new page button callback
-        new_page_button.configure(command=self.new_page)
+        new_page_button.configure(command=self.book.new_page)
+
+        # Initialize undo and redo of the focused page
+        self.window.bind("<Control-z>", lambda event: Book.history.undo())
+        self.window.bind("<Control-y>", lambda event: Book.history.redo())
 
-        # Initialize undo
-        self.actions = Deque(20)
-        self.window.bind("<Control-z>", lambda event: self.undo())
+        # Initialize formula clearing
+        self.window.bind("<Delete>", lambda event: self.clear_formula())
 
         # Initialize plot button callback
         plot_button.configure(command=lambda: ip.PlotWindow.toggle(self.window))
@@ -64,9 +71,6 @@ class App:
         # Initialize brush settings button
         brush_button.configure(command=lambda: self.brush.open_settings(self.window))
 
-        # Initialize OCR module
-        ir.init()
-
         # Start application
         self.window.mainloop()
 
@@ -86,38 +90,67 @@ class App:
         if not new_line:
             return
 
+        # Add line to page and, if we are not in free mode, to blackboard
+        page = self.book.focused_page
+        page.lines.append(new_line)
+        declared = self.draw_mode == "Declare"
+        if declared:
+            page.blackboard.add_line(new_line)
+
         # Save line to undo later
-        self.actions.put(new_line)
+        Book.history.record(AddStroke(new_line, page, declared))
 
-        # If we are not in free mode, add line to blackboard
-        if self.draw_mode == "Declare":
-            self.book.add_line(new_line)
+    def get_cursor_formula(self):
+        # Formula nearest to the cursor
+        x = Book.canvas.winfo_pointerx() - Book.canvas.winfo_rootx()
+        y = Book.canvas.winfo_pointery() - Book.canvas.winfo_rooty()
+        return self.book.get_nearest_formula(x, y)
 
     def evaluate(self):
-        last_formula = self.book.get_last_formula()
-        python_eq = fr.get_python_equation(last_formula, ip.get_variable_names())
+        formula = self.get_cursor_formula()
+
+        if formula is None:
+            return
+
+        # Wait for every character to be recognized or corrected
+        if not formula.is_predicted():
+            return
 
+        python_eq = formula.get_equation()
+
+        # Save interpreter state to undo the evaluation later
+        state_before = ip.get_state()
         ip.evaluate(python_eq)
+        Book.history.record(Evaluate(state_before, ip.get_state()))
+
+    def clear_formula(self):
+        # Delete key is also used to edit formula entries
+        if isinstance(self.window.focus_get(), tk.Entry):
+            return
+
+        formula = self.get_cursor_formula()
+        if formula is None:
+            return
+
+        # Delete every formula line in one command
+        page = self.book.focused_page
+        clear = CommandGroup([DeleteStroke(line, page, True) for char in formula.chars for line in char.lines])
+        clear.redo()
+        Book.history.record(clear)
 
     def set_mode(self, mode):
         self.draw_mode = mode
 
-    def undo(self):
-        last_action = self.actions.get()
-        if last_action:
-            last_action.delete()
-
-    def new_page(self):
-        self.book.new_page()
+    def bind_canvas(self, canvas):
         # Bind callbacks to the new canvas
         # Draw binds
-        Book.canvas.bind("<Button-1>", self.start_draw)
-        Book.canvas.bind("<B1-Motion>", self.stay_draw)
-        Book.canvas.bind("<ButtonRelease-1>", self.end_draw)
+        canvas.bind("<Button-1>", self.start_draw)
+        canvas.bind("<B1-Motion>", self.stay_draw)
+        canvas.bind("<ButtonRelease-1>", self.end_draw)
         # Mode binds
-        Book.canvas.bind("<Button-3>", lambda event: self.right_click_menu.tk_popup(Book.canvas.winfo_rootx() + event.x,
-                                                                                    Book.canvas.winfo_rooty() + event.y)
-                         )
+        canvas.bind("<Button-3>", lambda event: self.right_click_menu.tk_popup(canvas.winfo_rootx() + event.x,
+                                                                               canvas.winfo_rooty() + event.y)
+                    )
 
 
 if __name__ == "__main__":
@@ -1,11 +1,17 @@
 import tkinter as tk
 from tkinter import ttk
+import numpy as np
+
 import Draws as dr
+from Commands import HISTORY_SIZE
+from CustomQueues import CommandLog
 
 
 class Book:
-    # Static canvas variable
+    # Static page, canvas and undo history variables of the focused page
+    page = None
     canvas = None
+    history = None
 
     def __init__(self, root):
         # Create notebook
@@ -16,36 +22,46 @@ class Book:
         self.pages = []
         self.focused_page = None
 
-        # Bind events
-        def update_canvas():
-            page_index = self.notebook.index(self.notebook.select())
-            # Update static canvas
-            Book.canvas = self.pages[page_index].canvas
-            # Update focused page
-            self.focused_page = self.pages[page_index]
+        # Initialize canvas callback, called each time a page canvas is created
+        self.canvas_callback = lambda canvas: None
 
-        self.notebook.bind("<<NotebookTabChanged>>", lambda event: update_canvas())
+        # Bind events
+        self.notebook.bind("<<NotebookTabChanged>>", lambda event: self.focus_page(self.notebook.select()))
 
     def new_page(self):
         # Create new page
         new_page = DrawPage(self.notebook)
         self.pages.append(new_page)
         self.notebook.add(new_page.frame, text="Page " + str(len(self.pages)))
+        self.canvas_callback(new_page.canvas)
 
         # Select it
         self.notebook.select(len(self.pages) - 1)
-
-        # Update static canvas
-        Book.canvas = new_page.canvas
-
-        # Update focused page
-        self.focused_page = self.pages[-1]
+        self.focus_page(new_page.frame)
+
+    def focus_page(self, frame):
+        page = self.pages[self.notebook.index(frame)]
+        if page is self.focused_page:
+            return
+
+        # Hibernate the page left and wake the selected one
+        if self.focused_page is not None:
+            self.focused_page.hibernate()
+        if page.canvas is None:
+            page.wake()
+            self.canvas_callback(page.canvas)
+
+        # Update focused page and static variables
+        self.focused_page = page
+        Book.page = page
+        Book.canvas = page.canvas
+        Book.history = page.history
 
     def add_line(self, new_line):
         self.focused_page.blackboard.add_line(new_line)
 
-    def get_last_formula(self):
-        return self.focused_page.blackboard.get_last_formula()
+    def get_nearest_formula(self, x, y):
+        return self.focused_page.blackboard.get_nearest_formula(x, y)
 
     def set_mode(self, mode):
         self.focused_page.blackboard.mode = mode
@@ -57,6 +73,16 @@ class DrawPage:
         self.frame = ttk.Frame(root)
         self.frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
+        # Create canvases
+        self.canvas = None
+        self.create_canvases()
+
+        # Create page blackboard, lines and undo history
+        self.blackboard = dr.BlackBoard()
+        self.lines = []
+        self.history = CommandLog(HISTORY_SIZE)
+
+    def create_canvases(self):
         # Create global canvas and sub frame
         global_canvas = tk.Canvas(self.frame, background="gray")
 
@@ -85,5 +111,39 @@ class DrawPage:
         self.canvas = tk.Canvas(background_canvas, bg="black", width=1440, height=1527)
         self.canvas.place(relx=0.5, rely=0.5, anchor=tk.CENTER)
 
-        # Create page blackboard
-        self.blackboard = dr.BlackBoard()
+    def hibernate(self):
+        """ Destroys the page canvases and packs its stroke points in a single array """
+        if self.canvas is None:
+            return
+
+        # Detach formulas and lines from the canvas
+        for formula in self.blackboard.formulas:
+            formula.hibernate()
+
+        self.lines = [line for line in self.lines if line.is_valid]
+        for line in self.lines:
+            line.hibernate()
+
+        # Lines points become views on the page points
+        if len(self.lines) > 0:
+            points = np.concatenate([line.points for line in self.lines])
+            ends = np.cumsum([len(line.points) for line in self.lines])
+            starts = np.concatenate([[0], ends[:-1]])
+            for line, start, end in zip(self.lines, starts, ends):
+                line.points = points[start:end]
+
+        # Destroy canvases
+        for child in self.frame.winfo_children():
+            child.destroy()
+        self.canvas = None
+
+    def wake(self):
+        """ Rebuilds the canvases of a hibernating page """
+        if self.canvas is not None:
+            return
+
+        self.create_canvases()
+        for line in self.lines:
+            line.wake(self.canvas)
+        for formula in self.blackboard.formulas:
+            formula.wake(self.canvas)
@@ -0,0 +1,39 @@
+import json
+import os
+import re
+
+# Characters the recognizer can output
+RECOGNIZED_CHARACTERS = re.compile(r"[0-9A-Z+\-=/*()]")
+
+
+def load_rounds(directory):
+    """ Returns the rounds saved by DatabaseCreator (RoundN.json files) in the directory, sorted by round index """
+    names = [name for name in os.listdir(directory) if re.fullmatch(r"Round\d+\.json", name)]
+    names.sort(key=lambda name: int(name[5:-5]))
+
+    rounds = []
+    for name in names:
+        with open(os.path.join(directory, name), "r") as f:
+            rounds.append(json.load(f))
+
+    return rounds
+
+
+def target_characters(displayed_formula):
+    """ Returns the characters expected in the drawing of a displayed LaTeX formula """
+    # Remove LaTeX commands and keep recognizable characters
+    formula = re.sub(r"\\[a-zA-Z]+", "", displayed_formula).upper()
+    return RECOGNIZED_CHARACTERS.findall(formula)
+
+
+def round_characters(formula_round):
+    """ Returns the (character json, target) pairs of a round. Targets are None when the drawn characters can't be
+    aligned with the displayed formula """
+    chars = formula_round["drawn_formula"]["characters"]
+    targets = target_characters(formula_round["displayed_formula"])
+
+    if len(targets) != len(chars):
+        targets = [None] * len(chars)
+
+    return list(zip(chars, targets))
+
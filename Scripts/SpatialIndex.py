@@ -0,0 +1,111 @@
+import math
+
+
+class GridIndex:
+    def __init__(self, cell_size):
+        """ Uniform grid over box bounds, each cell holds the boxes overlapping it """
+        self.cell_size = cell_size
+        self.cells = {}      # Cell -> {box: insertion index}
+        self.box_cells = {}  # Box -> (covered cells, insertion index)
+        self.insertions = 0
+
+    def get_cells(self, box):
+        """ Returns the (column, row) cells covered by the box bounds """
+        x_min, y_min, x_max, y_max = box.get_bounds()
+        columns = range(math.floor(x_min / self.cell_size), math.floor(x_max / self.cell_size) + 1)
+        rows = range(math.floor(y_min / self.cell_size), math.floor(y_max / self.cell_size) + 1)
+        return [(column, row) for column in columns for row in rows]
+
+    def insert(self, box):
+        if box in self.box_cells:
+            self.update(box)
+            return
+
+        self.insertions += 1
+        cells = self.get_cells(box)
+        for cell in cells:
+            self.cells.setdefault(cell, {})[box] = self.insertions
+        self.box_cells[box] = (cells, self.insertions)
+
+    def remove(self, box):
+        if box not in self.box_cells:
+            return
+
+        cells, _ = self.box_cells.pop(box)
+        for cell in cells:
+            del self.cells[cell][box]
+            if len(self.cells[cell]) == 0:
+                del self.cells[cell]
+
+    def update(self, box):
+        """ Moves a box whose bounds changed to its new cells, keeping its insertion order """
+        cells, index = self.box_cells[box]
+        new_cells = self.get_cells(box)
+        if new_cells == cells:
+            return
+
+        # Only touch the cells the box left or entered
+        old_set, new_set = set(cells), set(new_cells)
+        for cell in old_set - new_set:
+            del self.cells[cell][box]
+            if len(self.cells[cell]) == 0:
+                del self.cells[cell]
+        for cell in new_set - old_set:
+            self.cells.setdefault(cell, {})[box] = index
+        self.box_cells[box] = (new_cells, index)
+
+    def query(self, box):
+        """ Returns the indexed boxes intersecting box, sorted by insertion order """
+        found = {}
+        for cell in self.get_cells(box):
+            for other, index in self.cells.get(cell, {}).items():
+                if other is not box and other.is_intersecting(box):
+                    found[other] = index
+
+        return sorted(found, key=found.get)
+
+    def nearest(self, x, y):
+        """ Returns the indexed box nearest to point (x, y), the most recent one in case of tie. Cells are visited in
+        growing rings around the point until no unvisited box can be nearer """
+        if len(self.box_cells) == 0:
+            return None
+
+        column, row = math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+        best, best_key, visited = None, None, set()
+        radius = 0
+        while len(visited) < len(self.box_cells):
+            # Boxes outside the visited rings are at least radius - 1 cells away
+            if best is not None and best_key[0] < (radius - 1) * self.cell_size:
+                break
+
+            for cell in ring_cells(column, row, radius):
+                for box, index in self.cells.get(cell, {}).items():
+                    if box in visited:
+                        continue
+                    visited.add(box)
+
+                    # Distance from the point to the box bounds
+                    x_min, y_min, x_max, y_max = box.get_bounds()
+                    key = (math.hypot(max(x_min - x, 0, x - x_max), max(y_min - y, 0, y - y_max)), -index)
+                    if best is None or key < best_key:
+                        best, best_key = box, key
+
+            radius += 1
+
+        return best
+
+    def __contains__(self, box):
+        return box in self.box_cells
+
+    def __len__(self):
+        return len(self.box_cells)
+
+
+def ring_cells(column, row, radius):
+    """ Returns the cells at Chebyshev distance radius from cell (column, row) """
+    if radius == 0:
+        return [(column, row)]
+
+    cells = [(column + offset, row + side) for offset in range(-radius, radius + 1) for side in [-radius, radius]]
+    cells += [(column + side, row + offset) for offset in range(-radius + 1, radius) for side in [-radius, radius]]
+    return cells
@@ -0,0 +1,31 @@
+from Box import Box
+import FormulaRepresentation as fr
+
+
+class Character(Box):
+    __slots__ = ("prediction",)
+
+    def __init__(self, prediction, x1, y1, x2, y2):
+        """ Recognized character without strokes """
+        super().__init__(x1, y1, x2, y2)
+        self.prediction = prediction
+
+    def get_type(self):
+        return fr.FrozenCharacter.get_type(self)
+
+    def __str__(self):
+        return self.prediction
+
+
+class Formula:
+    def __init__(self, chars):
+        self.chars = chars
+
+
+def write(string, x=0.0):
+    """ Characters of string written on one line """
+    chars = []
+    for prediction in string:
+        chars.append(Character(prediction, x, -20, x + 20, 20))
+        x += 25
+    return chars
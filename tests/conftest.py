@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Scripts import each other as top level modules, as when they are run from the Scripts directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts"))
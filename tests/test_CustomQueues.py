@@ -0,0 +1,136 @@
+from CustomQueues import CommandLog, CommandGroup, LRUCache
+
+
+class Append:
+    def __init__(self, values, value, size=10):
+        """ Command appending value to the values list """
+        self.values = values
+        self.value = value
+        self.command_size = size
+        self.redo()
+
+    def undo(self):
+        self.values.remove(self.value)
+
+    def redo(self):
+        self.values.append(self.value)
+
+    def size(self):
+        return self.command_size
+
+
+def test_undo_redo():
+    values, log = [], CommandLog(1000)
+    for value in range(3):
+        log.record(Append(values, value))
+
+    assert log.undo().value == 2
+    assert log.undo().value == 1
+    assert values == [0]
+    assert log.redo().value == 1
+    assert values == [0, 1]
+
+
+def test_nothing_to_undo_or_redo():
+    values, log = [], CommandLog(1000)
+    assert log.undo() is None
+    assert log.redo() is None
+
+    log.record(Append(values, 0))
+    assert log.redo() is None
+    log.undo()
+    assert log.undo() is None
+    assert values == []
+
+
+def test_record_forgets_undone_commands():
+    values, log = [], CommandLog(1000)
+    log.record(Append(values, 0))
+    log.record(Append(values, 1))
+    log.undo()
+    log.record(Append(values, 2))
+
+    assert log.redo() is None
+    assert log.size == 20
+    assert values == [0, 2]
+
+
+def test_size_cap_forgets_the_oldest_commands():
+    values, log = [], CommandLog(35)
+    for value in range(5):
+        log.record(Append(values, value))
+
+    # Only the three last commands fit
+    assert log.size == 30
+    for _ in range(5):
+        log.undo()
+    assert values == [0, 1]
+
+    # Undone commands still count until they are forgotten
+    assert log.size == 30
+    log.redo()
+    assert values == [0, 1, 2]
+
+
+def test_size_cap_keeps_the_last_command():
+    values, log = [], CommandLog(35)
+    log.record(Append(values, 0))
+    log.record(Append(values, 1, 100))
+
+    assert log.size == 100
+    assert log.undo().value == 1
+    assert log.undo() is None
+
+
+def test_command_group():
+    values, log = [], CommandLog(1000)
+    group = CommandGroup([Append(values, value) for value in range(3)])
+    log.record(group)
+
+    assert log.size == 30
+    log.undo()
+    assert values == []
+    log.redo()
+    assert values == [0, 1, 2]
+
+
+def test_lru_cache_evicts_the_least_recently_used_entry():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+
+    # Reading a makes b the least recently used entry
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_lru_cache_put_refreshes_existing_entries():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 10)
+    cache.put("c", 3)
+
+    assert cache.get("a") == 10
+    assert cache.get("b") is None
+
+
+def test_lru_cache_counts_hits():
+    cache = LRUCache(2, count_hits=True)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("b")
+    assert cache.info() == {"hits": 1, "misses": 1, "size": 1, "max_size": 2}
+
+    cache.clear()
+    assert cache.info() == {"hits": 0, "misses": 0, "size": 0, "max_size": 2}
+
+    # Without count_hits, lookups aren't counted
+    cache = LRUCache(2)
+    cache.get("a")
+    assert cache.info()["misses"] == 0
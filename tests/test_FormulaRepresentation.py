@@ -0,0 +1,116 @@
+import ast
+import random
+
+import pytest
+
+import FormulaRepresentation as fr
+from Writing import Character, Formula, write
+
+
+def random_page(rng, count):
+    """ Characters scattered over a page, a third of them horizontal lines """
+    chars = []
+    for _ in range(count):
+        x, y = rng.uniform(0, 1500), rng.uniform(0, 1500)
+        if rng.random() < 0.3:
+            chars.append(Character('-', x, y - 2, x + rng.uniform(20, 300), y + 2))
+        else:
+            chars.append(Character(rng.choice("0123456789XY+*"), x, y - 20, x + 20, y + 20))
+    return chars
+
+
+def test_interval_index_matches_linear_scan():
+    rng = random.Random(1)
+    intervals = [(left, left + rng.uniform(0, 200)) for left in (rng.uniform(0, 1000) for _ in range(300))]
+    index = fr.IntervalIndex(sorted(set(bound for interval in intervals for bound in interval)))
+
+    inserted = []
+    for left, right in intervals:
+        key = (rng.random(), len(inserted))
+        index.insert(left, right, key)
+        inserted.append((left, right, key))
+
+        # Queried ranges are the ones of indexed characters
+        query_left, query_right = intervals[rng.randrange(len(intervals))]
+        keys = [key for left, right, key in inserted if left <= query_right and right >= query_left]
+        assert index.query(query_left, query_right) == (max(keys) if keys else None)
+
+
+def test_classification_matches_linear_scan(monkeypatch):
+    rng = random.Random(2)
+    chars = random_page(rng, 3 * fr.LINEAR_SCAN_SIZE)
+    copies = [Character(char.prediction, *char.get_bounds()) for char in chars]
+
+    # Interval index on the first formula, linear scan on its copy
+    fr.classify_horizontal_lines(Formula(chars))
+    monkeypatch.setattr(fr, "LINEAR_SCAN_SIZE", len(copies))
+    fr.classify_horizontal_lines(Formula(copies))
+
+    assert [char.prediction for char in chars] == [char.prediction for char in copies]
+    assert any(char.prediction == '/' for char in chars) and any(char.prediction == '-' for char in chars)
+
+
+def test_parse_cache_keys_on_predictions_and_version():
+    chars = write("A=3+4")
+    equation = fr.get_python_equation(Formula(chars), ["A"], 0)
+
+    # Same characters, or characters written the same way, hit the cache
+    assert fr.get_python_equation(Formula(chars), ["A"], 0) is equation
+    assert fr.get_python_equation(Formula(write("A=3+4")), ["A"], 0) is equation
+
+    # A new prediction or a new symbol table version don't
+    chars[2].prediction = '5'
+    assert fr.get_python_equation(Formula(chars), ["A"], 0) is not equation
+    chars[2].prediction = '3'
+    assert fr.get_python_equation(Formula(chars), ["A"], 1) is not equation
+
+
+def test_cached_trees_keep_their_predictions():
+    chars = write("A=3+4")
+    equation = fr.get_python_equation(Formula(chars), ["A"], 0)
+    chars[2].prediction = '5'
+
+    assert str(equation) == "A=3+4"
+    assert eval(equation.right.compile()) == 7
+
+
+@pytest.mark.parametrize("string, variables, source", [
+    ("2X+3", [], "2*X+3"),
+    ("AB-C", ["AB"], "AB-C"),
+    ("AB-C", ["A", "B"], "A*B-C"),
+    ("2*(X+1)", [], "2*(X+1)"),
+    ("F(X)", [], "F(X)"),
+    ("F1X1", [], "F(X)"),
+    ("X*1*Y*1*2", [], "X(Y)*2"),
+    ("X--1", [], "X--1"),
+    ("3**2-4", [], "3**2-4"),
+    ("-X*Y", [], "-X*Y"),
+])
+def test_ast_of_a_line(string, variables, source):
+    expression = fr.Expression(write(string), variables)
+    assert ast.dump(expression.get_ast()) == ast.dump(ast.parse(source, mode="eval").body)
+
+
+def test_ast_of_powers_and_fractions():
+    # X squared plus six halves
+    chars = [Character('X', 0, -20, 20, 20), Character('2', 22, -45, 32, -25), Character('+', 40, -10, 60, 10),
+             Character('/', 70, -2, 110, 2), Character('6', 80, -45, 100, -5), Character('2', 80, 5, 100, 45)]
+    expression = fr.Expression(chars, [])
+    assert ast.dump(expression.get_ast()) == ast.dump(ast.parse("X**2+6/2", mode="eval").body)
+
+
+@pytest.mark.parametrize("string", ["3+", "(3", "3)", "05", "2*"])
+def test_invalid_lines_raise_syntax_errors(string):
+    with pytest.raises(SyntaxError):
+        fr.Expression(write(string), []).get_ast()
+
+
+def test_code_is_compiled_again_after_a_correction():
+    chars = write("3+4*X")
+    expression = fr.Expression(chars, ["X"])
+    assert eval(expression.compile(), {}, {"X": 2}) == 11
+    code = expression.compile()
+    assert expression.compile() is code
+
+    chars[0].prediction = '5'
+    assert eval(expression.compile(), {}, {"X": 2}) == 13
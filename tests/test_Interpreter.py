@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip("matplotlib")
+pytest.importorskip("sympy")
+
+import Draws
+import FormulaRepresentation as fr
+import Interpreter as ip
+from Writing import Formula, write
+
+
+@pytest.fixture(autouse=True)
+def empty_interpreter():
+    ip.set_state(({}, {}, {}))
+    yield
+    ip.set_state(({}, {}, {}))
+
+
+def get_equation(formula):
+    return fr.get_python_equation(formula, ip.get_variable_names(), ip.version)
+
+
+def test_reevaluation_after_a_correction():
+    chars = write("A=3+4")
+    formula = Formula(chars)
+    ip.evaluate(get_equation(formula))
+    assert ip.variables_eval["A"] == 7
+
+    # Correct a digit by hand, the formula has to be parsed again
+    parse_key = Draws.Formula.get_parse_key(formula)
+    chars[2].prediction = '5'
+    assert Draws.Formula.get_parse_key(formula) != parse_key
+
+    ip.evaluate(get_equation(formula))
+    assert ip.variables_eval["A"] == 9
+
+
+def test_reevaluation_after_a_correction_is_undone():
+    chars = write("A=3+4")
+    formula = Formula(chars)
+    ip.evaluate(get_equation(formula))
+
+    chars[2].prediction = '5'
+    ip.evaluate(get_equation(formula))
+    chars[2].prediction = '3'
+    ip.evaluate(get_equation(formula))
+
+    assert ip.variables_eval["A"] == 7
+
+
+def test_version_changes_with_declared_names_only():
+    version = ip.version
+    ip.evaluate(get_equation(Formula(write("A=3"))))
+    assert ip.version == version + 1
+    state = ip.get_state()
+
+    # Updating a variable or restoring the same names keeps the parse trees
+    ip.evaluate(get_equation(Formula(write("A=5"))))
+    ip.set_state(state)
+    assert ip.version == version + 1
+
+    ip.set_state(({}, {}, {}))
+    assert ip.version == version + 2
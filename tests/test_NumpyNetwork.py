@@ -0,0 +1,68 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import NumpyNetwork
+
+MODELS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Models")
+KERAS_MODEL_PATH = os.path.join(MODELS_DIRECTORY, "handwriting.model")
+NUMPY_MODEL_PATH = os.path.join(MODELS_DIRECTORY, "handwriting.npz")
+
+
+@pytest.fixture(scope="module")
+def keras_model(tmp_path_factory):
+    tf = pytest.importorskip("tensorflow")
+
+    # Recent Keras versions only read HDF5 models with a .h5 extension
+    model_path = str(tmp_path_factory.mktemp("model") / "handwriting.h5")
+    shutil.copy(KERAS_MODEL_PATH, model_path)
+    return tf.keras.models.load_model(model_path, compile=False)
+
+
+@pytest.fixture(scope="module")
+def images():
+    random = np.random.default_rng(0)
+    return np.concatenate([random.random((16, 32, 32), dtype=np.float32),
+                           (random.random((16, 32, 32)) > 0.8).astype(np.float32)])
+
+
+def test_numpy_network_agrees_with_keras(keras_model, images):
+    keras_output = np.asarray(keras_model.predict_on_batch(images[:, :, :, None]))
+    numpy_output = NumpyNetwork.Network(NUMPY_MODEL_PATH).predict_on_batch(images)
+
+    assert numpy_output.shape == keras_output.shape
+    np.testing.assert_allclose(numpy_output, keras_output, atol=1e-4)
+    assert np.array_equal(np.argmax(numpy_output, axis=1), np.argmax(keras_output, axis=1))
+
+
+def test_single_image_batches_agree_with_keras(keras_model, images):
+    network = NumpyNetwork.Network(NUMPY_MODEL_PATH)
+    for image in images[:4]:
+        np.testing.assert_allclose(network.predict_on_batch(image[None]),
+                                   keras_model.predict_on_batch(image[None, :, :, None]), atol=1e-4)
+
+
+def test_export_reproduces_the_shipped_model(tmp_path, images):
+    pytest.importorskip("h5py")
+    npz_path = str(tmp_path / "handwriting.npz")
+    NumpyNetwork.export(KERAS_MODEL_PATH, npz_path)
+
+    np.testing.assert_allclose(NumpyNetwork.Network(npz_path).predict_on_batch(images),
+                               NumpyNetwork.Network(NUMPY_MODEL_PATH).predict_on_batch(images), atol=1e-6)
+
+
+def test_conv2d_matches_direct_convolution():
+    random = np.random.default_rng(1)
+    x = random.random((2, 9, 8, 3), dtype=np.float32)
+    kernel = random.random((3, 2, 3, 4), dtype=np.float32)
+
+    # Valid convolution with strides, one output pixel at a time
+    expected = np.zeros((2, 4, 4, 4), dtype=np.float32)
+    for i in range(4):
+        for j in range(4):
+            patch = x[:, 2 * i:2 * i + 3, 2 * j:2 * j + 2, :]
+            expected[:, i, j, :] = np.tensordot(patch, kernel, axes=([1, 2, 3], [0, 1, 2]))
+
+    np.testing.assert_allclose(NumpyNetwork.conv2d(x, kernel, (2, 2), "valid"), expected, rtol=1e-5)
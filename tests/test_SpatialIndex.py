@@ -0,0 +1,95 @@
+import math
+import random
+
+from Box import Box
+from SpatialIndex import GridIndex
+
+
+def random_boxes(rng, count):
+    boxes = []
+    for _ in range(count):
+        x, y = rng.uniform(-500, 1500), rng.uniform(-500, 1500)
+        boxes.append(Box(x, y, x + rng.uniform(1, 300), y + rng.uniform(1, 300)))
+    return boxes
+
+
+def test_query_matches_linear_scan():
+    rng = random.Random(0)
+    boxes = random_boxes(rng, 200)
+    index = GridIndex(64)
+    for box in boxes:
+        index.insert(box)
+
+    for query in random_boxes(rng, 200):
+        assert index.query(query) == [box for box in boxes if box.is_intersecting(query)]
+
+
+def test_query_after_update_and_remove():
+    rng = random.Random(1)
+    boxes = random_boxes(rng, 100)
+    index = GridIndex(64)
+    for box in boxes:
+        index.insert(box)
+
+    # Grow boxes across cells and remove others, insertion order is kept
+    for box in boxes[::3]:
+        box.merge_box(random_boxes(rng, 1)[0])
+        index.update(box)
+    for box in boxes[1::4]:
+        index.remove(box)
+    boxes = [box for i, box in enumerate(boxes) if i % 4 != 1]
+
+    assert len(index) == len(boxes)
+    for query in random_boxes(rng, 200):
+        assert index.query(query) == [box for box in boxes if box.is_intersecting(query)]
+
+
+def test_query_skips_the_queried_box():
+    index = GridIndex(64)
+    box, other = Box(0, 0, 10, 10), Box(5, 5, 20, 20)
+    index.insert(box)
+    index.insert(other)
+
+    assert index.query(box) == [other]
+
+
+def nearest_linear(boxes, x, y):
+    """ Nearest box to (x, y) by distance to its bounds, the most recent one in case of tie """
+    def key(i):
+        x_min, y_min, x_max, y_max = boxes[i].get_bounds()
+        return math.hypot(max(x_min - x, 0, x - x_max), max(y_min - y, 0, y - y_max)), -i
+
+    return boxes[min(range(len(boxes)), key=key)]
+
+
+def test_nearest_matches_linear_scan():
+    rng = random.Random(2)
+    boxes = random_boxes(rng, 150)
+    index = GridIndex(64)
+    for box in boxes:
+        index.insert(box)
+
+    # Points inside, between and far away from the boxes
+    for _ in range(300):
+        x, y = rng.uniform(-3000, 4000), rng.uniform(-3000, 4000)
+        assert index.nearest(x, y) is nearest_linear(boxes, x, y)
+
+
+def test_nearest_prefers_the_most_recent_box():
+    index = GridIndex(64)
+    boxes = [Box(0, 0, 100, 100), Box(50, 50, 150, 150)]
+    for box in boxes:
+        index.insert(box)
+
+    assert index.nearest(75, 75) is boxes[1]
+    assert index.nearest(-10, -10) is boxes[0]
+
+
+def test_nearest_of_empty_index():
+    index = GridIndex(64)
+    assert index.nearest(0, 0) is None
+
+    box = Box(0, 0, 10, 10)
+    index.insert(box)
+    index.remove(box)
+    assert index.nearest(0, 0) is None